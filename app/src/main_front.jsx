@@ -577,6 +577,7 @@ export default function App() {
   const scrollRef = useRef(null);
   const inputRef = useRef(null);
   const abortRef = useRef(null);
+  const turnRef = useRef(0);
   const toolsRef = useRef([]);
   const imageUploadRef = useRef(null);
   const reportUploadRef = useRef(null);
@@ -657,24 +658,54 @@ export default function App() {
   };
 
   const handleReportUpload = async (e) => {
-    const file = e.target.files?.[0];
-    if (!file) return;
-    setStatus(`Ingesting ${file.name}...`);
+    const files = Array.from(e.target.files || []);
+    if (!files.length) return;
+    e.target.value = "";
+    const say = (content) => setMsgs(prev => [...prev, { role: "assistant", content, sources: [], images: [], related: [], toolCalls: [] }]);
+    setStatus(`Uploading ${files.length > 1 ? `${files.length} reports` : files[0].name}...`);
     const formData = new FormData();
-    formData.append("file", file);
+    files.forEach(f => formData.append("files", f));
+    let jobIds;
     try {
       const res = await fetch(`${API}/upload/report`, { method: "POST", body: formData });
       const data = await res.json();
-      if (data.error) {
-        setMsgs(prev => [...prev, { role: "assistant", content: `Upload failed: ${data.error}`, sources: [], images: [], related: [], toolCalls: [] }]);
-      } else {
-        setMsgs(prev => [...prev, { role: "assistant", content: `Report ingested: **${data.filename}** — ${data.chunks_added} chunks added.`, sources: [], images: [], related: [], toolCalls: [] }]);
+      (data.errors || []).forEach(err => say(`Upload failed: **${err.filename}** — ${err.error}`));
+      if (!data.jobs) {
+        if (!data.errors) say(`Upload failed: ${data.error}`);
+        setStatus(null);
+        return;
       }
+      jobIds = data.jobs.map(j => j.job_id);
     } catch {
-      setMsgs(prev => [...prev, { role: "assistant", content: "Report upload failed.", sources: [], images: [], related: [], toolCalls: [] }]);
+      say("Report upload failed.");
+      setStatus(null);
+      return;
     }
-    setStatus(null);
-    e.target.value = "";
+
+    const reported = new Set();
+    const poll = setInterval(async () => {
+      try {
+        const r = await fetch(`${API}/ingest-progress`);
+        const jobs = (await r.json()).jobs.filter(j => jobIds.includes(j.job_id));
+        jobs.filter(j => (j.status === "done" || j.status === "error") && !reported.has(j.job_id)).forEach(j => {
+          reported.add(j.job_id);
+          say(j.status === "done"
+            ? `Report ingested: **${j.filename}** — ${j.chunks_added} chunks added.`
+            : `Upload failed: **${j.filename}** — ${j.error}`);
+        });
+        const active = jobs.find(j => j.status === "running");
+        if (active) {
+          const step = active.chunks_total
+            ? `${active.chunks_embedded}/${active.chunks_total} chunks embedded`
+            : `${active.pages_parsed}/${active.pages_total} pages parsed`;
+          setStatus(`Ingesting ${active.filename}: ${step}`);
+        }
+        if (reported.size >= jobIds.length || jobs.length < jobIds.length) {
+          clearInterval(poll);
+          setStatus(null);
+        }
+      } catch {}
+    }, 1000);
   };
 
   const send = useCallback(async (overrideText) => {
@@ -711,7 +742,9 @@ export default function App() {
     const queryText = includeImages ? text + " (include relevant inspection images)" : text;
     setWantImages(false);
     setMsgs(prev => [...prev, { role: "user", content: displayText }]);
-    setMsgs(prev => [...prev, { role: "assistant", content: "", sources: [], images: [], related: [], toolCalls: [], question: displayText }]);
+    // Related questions can arrive after the next question was sent, so they are matched to their turn.
+    const turn = ++turnRef.current;
+    setMsgs(prev => [...prev, { role: "assistant", content: "", sources: [], images: [], related: [], toolCalls: [], question: displayText, turn }]);
 
     const ctrl = new AbortController();
     abortRef.current = ctrl;
@@ -739,10 +772,13 @@ export default function App() {
             } else if (ev.type === "tool_call") {
               const meta = TOOL_META[ev.name] || { verb: ev.name };
               setStatus(`${meta.verb}...`);
-              toolsRef.current = [...toolsRef.current, { name: ev.name, input: ev.input }];
+              toolsRef.current = [...toolsRef.current, { id: ev.id, name: ev.name, input: ev.input }];
             } else if (ev.type === "tool_result") {
+              // Parallel tool calls can finish out of order, so match on the call id.
               const steps = [...toolsRef.current];
-              if (steps.length) steps[steps.length - 1].preview = ev.preview;
+              const idx = ev.id ? steps.findIndex(s => s.id === ev.id) : -1;
+              const target = idx >= 0 ? idx : steps.length - 1;
+              if (target >= 0) steps[target] = { ...steps[target], preview: ev.preview };
               toolsRef.current = steps;
             } else if (ev.type === "token") {
               setStatus(null);
@@ -761,6 +797,13 @@ export default function App() {
                 if (l?.role === "assistant") u[u.length - 1] = { ...l, sources: ev.sources || [], images: ev.images || [], related: ev.related || [], toolCalls: [...toolsRef.current] };
                 return u;
               });
+              // The answer is complete: accept the next question while related questions load.
+              if (abortRef.current === ctrl) abortRef.current = null;
+              setLoading(false);
+              setStreaming(false);
+              inputRef.current?.focus();
+            } else if (ev.type === "related") {
+              setMsgs(prev => prev.map(m => m.turn === turn ? { ...m, related: ev.related || [] } : m));
             }
           } catch {}
         }
@@ -775,6 +818,8 @@ export default function App() {
         });
       }
     }
+    // Already released on done, or by stop(); a newer question may own the state now.
+    if (abortRef.current !== ctrl) return;
     abortRef.current = null;
     setLoading(false);
     setStreaming(false);
@@ -791,7 +836,7 @@ export default function App() {
   return (
     <div style={{ position: "fixed", inset: 0, display: "flex", flexDirection: "row", fontFamily: F, background: t.bg, transition: "background 0.2s" }}>
       <input type="file" accept="image/*" ref={imageUploadRef} onChange={handleImageUpload} style={{ display: "none" }} />
-      <input type="file" accept=".pdf" ref={reportUploadRef} onChange={handleReportUpload} style={{ display: "none" }} />
+      <input type="file" accept=".pdf" multiple ref={reportUploadRef} onChange={handleReportUpload} style={{ display: "none" }} />
 
       <style>{`
         @import url('https://fonts.googleapis.com/css2?family=Inter:wght@300;400;500;600;700&family=JetBrains+Mono:wght@400;500&display=swap');
@@ -1,16 +1,23 @@
 from __future__ import annotations
+import asyncio
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import re
 from langchain_core.messages import SystemMessage, HumanMessage, AIMessage, ToolMessage
 from langchain_core.tools import tool
 from clip_index import search_images as clip_search
 from pipeline import retrieve, build_context_block, build_llm
-from config import API_KEY, PROMPT_FILE
+from config import API_KEY, PROMPT_FILE, AGENT_TOOL_WORKERS, RELATED_QUESTIONS_ENABLED
 
 _store = None
 _llm_with_tools = None
 _llm_streaming = None
 _system_prompt = ""
+# Tools, CLIP and the cross-encoder are blocking; they run here so the event loop
+# keeps serving other requests. Bounded so a burst of chats cannot oversubscribe the CPU.
+_tool_executor = ThreadPoolExecutor(max_workers=AGENT_TOOL_WORKERS, thread_name_prefix="agent-tool")
 
 @tool
 def search_reports(query: str) -> str:
@@ -25,9 +32,11 @@ def search_reports(query: str) -> str:
     return f"Sources: {', '.join(sources)}\n\n{context}"
 
 @tool
-def search_images(query: str, num_results: int = 8) -> str:
-    """Search the inspection image database using CLIP visual similarity. Use ONLY when the user explicitly asks to see images, photos, or visual examples."""
-    results = clip_search(query, k=num_results)
+def search_images(query: str, num_results: int = 8, label: str = "", min_severity: str = "",
+                  min_width: int = 0, min_height: int = 0) -> str:
+    """Search the inspection image database using CLIP visual similarity. Use ONLY when the user explicitly asks to see images, photos, or visual examples. Optionally restrict to a defect label (e.g. "coating disbondment"), a minimum severity (minor, moderate, severe, critical) and a minimum width/height in pixels (e.g. min_width=1280 for high-resolution frames)."""
+    results = clip_search(query, k=num_results, label=label or None, min_severity=min_severity or None,
+                          min_width=min_width or 0, min_height=min_height or 0)
     if not results:
         return "No relevant images found."
     lines = []
@@ -38,20 +47,15 @@ def search_images(query: str, num_results: int = 8) -> str:
 @tool
 def classify_defect(image_path: str) -> str:
     """Classify the type and severity of a defect in an inspection image using CLIP zero-shot classification. Provide an image path from search_images results."""
-    from clip_index import classify_image
-    from PIL import Image
-    from config import IMAGES_DIR
+    from clip_index import classify_image_bytes, classify_indexed_image, resolve_image_path
 
-    full_path = Path(IMAGES_DIR) / image_path
-    if not full_path.exists():
-        for p in Path(IMAGES_DIR).rglob(Path(image_path).name):
-            full_path = p
-            break
-    if not full_path.exists():
-        return f"Image not found: {image_path}"
-
-    img = Image.open(full_path).convert("RGB")
-    result = classify_image(img)
+    # Indexed images already have their scores stored next to the embedding.
+    result = classify_indexed_image(image_path)
+    if result is None:
+        full_path = resolve_image_path(image_path)
+        if full_path is None:
+            return f"Image not found: {image_path}"
+        result = classify_image_bytes(full_path.read_bytes())
 
     report = f"DEFECT ANALYSIS: {image_path}\n\n"
     report += "Defect Classification:\n"
@@ -87,7 +91,7 @@ You have access to tools. ALWAYS use tools before answering — never guess.
 
 Tools:
 - search_reports: Search PDF reports/standards. Use for any technical question.
-- search_images: CLIP visual search. Use when user wants images or visual evidence.
+- search_images: CLIP visual search. Use when user wants images or visual evidence. Pass label/min_severity to narrow results (e.g. coating disbondment rated moderate or worse), and min_width/min_height when the user wants large or high-resolution images.
 - classify_defect: Analyze a specific image. Requires image_path from search_images.
 - check_standard: Look up acceptance criteria. Use after identifying a defect.
 
@@ -122,7 +126,55 @@ def init_agent(store, llm_instance=None):
     _llm_streaming = build_llm(streaming=True, max_tokens=1024)
     return _llm_with_tools
 
-def run_agent_turn(question: str, history: list[dict] = None, max_iterations: int = 3, use_images: bool = True):
+async def run_blocking(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    call = functools.partial(contextvars.copy_context().run, fn, *args, **kwargs)
+    return await loop.run_in_executor(_tool_executor, call)
+
+def _invoke_tool(tool_name: str, tool_args: dict) -> str:
+    if tool_name not in TOOL_MAP:
+        return f"Unknown tool: {tool_name}"
+    try:
+        return TOOL_MAP[tool_name].invoke(tool_args)
+    except Exception as e:
+        return f"Tool error: {str(e)}"
+
+def _search_images_for_display(query: str, tool_args: dict) -> list[dict]:
+    try:
+        return clip_search(
+            tool_args.get("query", query), k=tool_args.get("num_results", 8),
+            label=tool_args.get("label") or None, min_severity=tool_args.get("min_severity") or None,
+            min_width=tool_args.get("min_width") or 0, min_height=tool_args.get("min_height") or 0,
+        )
+    except ValueError:
+        return []
+
+async def _related_questions(question: str, final_text: str) -> list[str]:
+    try:
+        result = await _llm_streaming.ainvoke([
+            SystemMessage(content=(
+                "Output exactly 3 follow-up questions a subsea engineer might ask about this topic. "
+                "Rules: one per line, no numbering, no bullets, no headers, no markdown. "
+                "Never use 'you' or 'your' — questions must be about the technical subject. "
+                "Max 10 words each."
+            )),
+            HumanMessage(content=f"Topic: {question}\nContext: {final_text[:300]}"),
+        ])
+        lines = [l.strip() for l in result.content.strip().split("\n") if l.strip()]
+        clean = []
+        for l in lines:
+            if l.startswith("#") or l.startswith("*") or l.startswith("-"):
+                continue
+            l = re.sub(r"^\d+[\.\)]\s*", "", l).strip()
+            if re.search(r'\byou(r|rs)?\b', l, re.IGNORECASE):
+                continue
+            if l and len(l) > 5 and l.endswith("?"):
+                clean.append(l)
+        return clean[:3]
+    except:
+        return []
+
+async def run_agent_turn(question: str, history: list[dict] = None, max_iterations: int = 3, use_images: bool = True):
     """Run the agent loop: tool calls then streamed final answer."""
     if _llm_with_tools is None:
         yield {"type": "token", "content": "Agent not initialized."}
@@ -147,17 +199,14 @@ def run_agent_turn(question: str, history: list[dict] = None, max_iterations: in
     yield {"type": "thinking", "content": "Planning approach..."}
 
     for _ in range(max_iterations):
-        response = _llm_with_tools.invoke(messages)
+        response = await _llm_with_tools.ainvoke(messages)
         messages.append(response)
 
         if not response.tool_calls:
             if not tools_used:
                 messages.pop()
                 yield {"type": "tool_call", "name": "search_reports", "input": {"query": question}}
-                try:
-                    result = search_reports.invoke({"query": question})
-                except Exception as e:
-                    result = f"Tool error: {str(e)}"
+                result = await run_blocking(_invoke_tool, "search_reports", {"query": question})
                 yield {
                     "type": "tool_result",
                     "name": "search_reports",
@@ -176,35 +225,43 @@ def run_agent_turn(question: str, history: list[dict] = None, max_iterations: in
                 break
 
         tools_used = True
-        for tc in response.tool_calls:
-            tool_name = tc["name"]
-            tool_args = tc["args"]
-            tool_id = tc["id"]
-
-            yield {"type": "tool_call", "name": tool_name, "input": tool_args}
-
-            if tool_name in TOOL_MAP:
-                try:
-                    result = TOOL_MAP[tool_name].invoke(tool_args)
-                except Exception as e:
-                    result = f"Tool error: {str(e)}"
-            else:
-                result = f"Unknown tool: {tool_name}"
-
-            yield {
-                "type": "tool_result",
-                "name": tool_name,
-                "content": result[:200] + "..." if len(result) > 200 else result,
-            }
+        calls = response.tool_calls
+        for tc in calls:
+            yield {"type": "tool_call", "id": tc["id"], "name": tc["name"], "input": tc["args"]}
+
+        async def run_call(i: int, tc: dict):
+            result = await run_blocking(_invoke_tool, tc["name"], tc["args"])
+            imgs = []
+            if tc["name"] == "search_images":
+                imgs = await run_blocking(_search_images_for_display, question, tc["args"])
+            return i, result, imgs
+
+        # Independent calls from one response run concurrently; results stream as
+        # they finish, but messages and sources are recorded in call order.
+        tasks = [asyncio.create_task(run_call(i, tc)) for i, tc in enumerate(calls)]
+        outcomes = [None] * len(calls)
+        try:
+            for fut in asyncio.as_completed(tasks):
+                i, result, imgs = await fut
+                outcomes[i] = (result, imgs)
+                yield {
+                    "type": "tool_result",
+                    "id": calls[i]["id"],
+                    "name": calls[i]["name"],
+                    "content": result[:200] + "..." if len(result) > 200 else result,
+                }
+        finally:
+            for t in tasks:
+                t.cancel()
 
-            if tool_name == "search_reports" and "Sources:" in result:
+        for tc, (result, imgs) in zip(calls, outcomes):
+            if tc["name"] == "search_reports" and "Sources:" in result:
                 src_line = result.split("\n")[0].replace("Sources: ", "")
                 collected_sources.extend([s.strip() for s in src_line.split(",")])
-            elif tool_name == "search_images":
-                imgs = clip_search(tool_args.get("query", question), k=tool_args.get("num_results", 8))
+            elif tc["name"] == "search_images":
                 collected_images.extend(imgs)
 
-            messages.append(ToolMessage(content=result, tool_call_id=tool_id))
+            messages.append(ToolMessage(content=result, tool_call_id=tc["id"]))
 
     yield {"type": "thinking", "content": "Synthesizing answer..."}
 
@@ -217,7 +274,7 @@ def run_agent_turn(question: str, history: list[dict] = None, max_iterations: in
 
     final_text = ""
     try:
-        for chunk in _llm_streaming.stream(messages):
+        async for chunk in _llm_streaming.astream(messages):
             token = chunk.content
             if isinstance(token, str) and token:
                 final_text += token
@@ -226,30 +283,9 @@ def run_agent_turn(question: str, history: list[dict] = None, max_iterations: in
         final_text = f"Error: {str(e)}"
         yield {"type": "token", "content": final_text}
 
-    related = []
-    try:
-        result = _llm_streaming.invoke([
-            SystemMessage(content=(
-                "Output exactly 3 follow-up questions a subsea engineer might ask about this topic. "
-                "Rules: one per line, no numbering, no bullets, no headers, no markdown. "
-                "Never use 'you' or 'your' — questions must be about the technical subject. "
-                "Max 10 words each."
-            )),
-            HumanMessage(content=f"Topic: {question}\nContext: {final_text[:300]}"),
-        ])
-        lines = [l.strip() for l in result.content.strip().split("\n") if l.strip()]
-        clean = []
-        for l in lines:
-            if l.startswith("#") or l.startswith("*") or l.startswith("-"):
-                continue
-            l = re.sub(r"^\d+[\.\)]\s*", "", l).strip()
-            if re.search(r'\byou(r|rs)?\b', l, re.IGNORECASE):
-                continue
-            if l and len(l) > 5 and l.endswith("?"):
-                clean.append(l)
-        related = clean[:3]
-    except:
-        pass
+    related_task = None
+    if RELATED_QUESTIONS_ENABLED:
+        related_task = asyncio.create_task(_related_questions(question, final_text))
 
     picked_paths = re.findall(r'\[IMAGE:\s*([^\]]+)\]', final_text)
     picked_images = []
@@ -269,9 +305,17 @@ def run_agent_turn(question: str, history: list[dict] = None, max_iterations: in
     seen_paths = set()
     unique_images = [img for img in picked_images if not (img["path"] in seen_paths or seen_paths.add(img["path"]))]
 
-    yield {
-        "type": "done",
-        "sources": unique_sources[:8],
-        "images": unique_images[:16],
-        "related": related,
-    }
\ No newline at end of file
+    # Sources and images are final now; follow-up questions arrive afterwards as
+    # a separate "related" event so citations are not held back by another LLM call.
+    try:
+        yield {
+            "type": "done",
+            "sources": unique_sources[:8],
+            "images": unique_images[:16],
+            "related": [],
+        }
+        if related_task is not None:
+            yield {"type": "related", "related": await related_task}
+    finally:
+        if related_task is not None:
+            related_task.cancel()
\ No newline at end of file
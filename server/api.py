@@ -1,4 +1,3 @@
-import io
 import json
 import time
 from pathlib import Path
@@ -7,12 +6,18 @@ from fastapi import FastAPI, Request, UploadFile, File, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse
 from fastapi.staticfiles import StaticFiles
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel
-from vectorstore import build_vectorstore
-from clip_index import load_clip_index, search_images, rebuild_clip_index, _rebuild_progress
-from pipeline import build_llm, load_system_prompt, retrieve, build_context_block, build_messages
+from vectorstore import build_vectorstore, add_report_listener
+from clip_index import load_clip_index, search_images, rebuild_clip_index, search_cache_stats, warm_up_clip, _load_clip, _rebuild_progress
+from pipeline import build_llm, load_system_prompt, retrieve, build_context_block, build_messages, warm_up_reranker, _get_reranker, rerank_cache_stats
 from agent import init_agent, run_agent_turn
-from cache import SemanticCache
+from cache import SemanticCache, reports_from_sources
+from query_embeddings import query_scope, query_embedding_stats
+from bm25 import lexical_index_stats
+from classify_cache import classification_cache_stats
+from models import get_model, start_idle_unloader, model_report
+from startup import ModelSpec, startup_step, start_warm_up, startup_report, is_ready
 from logger import log_interaction, get_stats, log_feedback, save_session_turn, load_session
 from config import CACHE_ENABLED, STATIC_IMAGES_DIR
 
@@ -26,13 +31,30 @@ _chat_histories: dict[str, list] = {}
 async def lifespan(app: FastAPI):
     global _store, _llm, _system_prompt
     print("Starting Subsea RAG Agent...")
-    _store = build_vectorstore()
-    _llm = build_llm()
-    _system_prompt = load_system_prompt()
-    load_clip_index()
-    init_agent(_store, _llm)
+    with startup_step("vectorstore"):
+        _store = build_vectorstore()
+    with startup_step("llm"):
+        _llm = build_llm()
+        _system_prompt = load_system_prompt()
+    with startup_step("clip_index"):
+        load_clip_index()
+    with startup_step("agent"):
+        init_agent(_store, _llm)
+    with startup_step("semantic_cache"):
+        _cache.load()
+        _cache.start_compaction()
+        # Ingesting or replacing a report evicts only the answers that depend on it.
+        add_report_listener(_cache.invalidate_reports)
+    # Models load in parallel in the background; /health reports ready once warm.
+    start_warm_up([
+        ModelSpec("clip", _load_clip, warm_up_clip),
+        ModelSpec("reranker", _get_reranker, warm_up_reranker),
+        ModelSpec("embedder", lambda: get_model("embedder"), _cache.warm_up),
+    ])
+    start_idle_unloader()
     print("Agent ready")
     yield
+    _cache.close()
 
 app = FastAPI(title="SAGA", lifespan=lifespan)
 app.add_middleware(
@@ -58,6 +80,10 @@ class ChatRequest(BaseModel):
 class ImageSearchRequest(BaseModel):
     query: str
     k: int = 16
+    label: str | None = None
+    min_severity: str | None = None
+    min_width: int = 0
+    min_height: int = 0
 
 class FeedbackRequest(BaseModel):
     session_id: str = "default"
@@ -69,15 +95,25 @@ class FeedbackRequest(BaseModel):
 def health():
     return {
         "status": "ok",
+        "ready": is_ready(),
         "store_ready": _store is not None,
         "llm_ready": _llm is not None,
         "cache_size": _cache.size,
         "agent": True,
+        "startup": startup_report(),
     }
 
 @app.get("/stats")
 def stats():
-    return get_stats()
+    result = get_stats()
+    result["image_search_cache"] = search_cache_stats()
+    result["classification_cache"] = classification_cache_stats()
+    result["rerank_cache"] = rerank_cache_stats()
+    result["lexical_index"] = lexical_index_stats()
+    result["semantic_cache"] = _cache.stats()
+    result["query_embeddings"] = query_embedding_stats()
+    result["models"] = model_report()
+    return result
 
 @app.post("/feedback")
 async def feedback(req: FeedbackRequest):
@@ -86,42 +122,79 @@ async def feedback(req: FeedbackRequest):
 
 @app.post("/upload/image")
 async def upload_image(file: UploadFile = File(...)):
-    from PIL import Image
-    from clip_index import classify_image
+    from clip_index import classify_image_bytes
 
     contents = await file.read()
     try:
-        img = Image.open(io.BytesIO(contents)).convert("RGB")
-        result = classify_image(img)
+        result = await run_in_threadpool(classify_image_bytes, contents)
         result["filename"] = file.filename
         return result
     except Exception as e:
         return {"error": str(e), "filename": file.filename}
 
 @app.post("/upload/report")
-async def upload_report(file: UploadFile = File(...)):
-    from vectorstore import ingest_pdf
+async def upload_report(files: list[UploadFile] = File(None), file: UploadFile = File(None)):
+    from ingest_jobs import submit_report
 
     if _store is None:
         return {"error": "Vectorstore not ready"}
 
-    contents = await file.read()
-    filename = file.filename or "uploaded_report.pdf"
-    if not filename.lower().endswith(".pdf"):
-        return {"error": "Only PDF files are supported"}
+    uploads = list(files or []) + ([file] if file else [])
+    if not uploads:
+        return {"error": "No files uploaded"}
+
+    # Parsing and embedding run on the ingest workers; poll /ingest-progress.
+    jobs, errors = [], []
+    for upload in uploads:
+        filename = upload.filename or "uploaded_report.pdf"
+        if not filename.lower().endswith(".pdf"):
+            errors.append({"filename": filename, "error": "Only PDF files are supported"})
+            continue
+        contents = await upload.read()
+        jobs.append(submit_report(_store, contents, filename))
+    if not jobs:
+        return {"error": errors[0]["error"], "errors": errors}
+    return {"status": "queued", "jobs": jobs, "errors": errors}
+
+@app.get("/ingest-progress")
+def ingest_progress(job_id: str = None):
+    from ingest_jobs import get_job, list_jobs
+    if job_id:
+        job = get_job(job_id)
+        return job if job else {"error": f"Unknown job '{job_id}'"}
+    return {"jobs": list_jobs()}
+
+@app.post("/sync-reports")
+async def sync_reports_endpoint():
+    from vectorstore import sync_reports
 
-    try:
-        chunks_added = ingest_pdf(_store, contents, filename)
-        return {"status": "ok", "filename": filename, "chunks_added": chunks_added}
-    except Exception as e:
-        return {"error": str(e), "filename": filename}
+    if _store is None:
+        return {"error": "Vectorstore not ready"}
+    return await run_in_threadpool(sync_reports, _store)
 
+# Not under /images: the static mount there would shadow it.
+@app.get("/classified-images")
+def classified_images(severity: str = None, defect: str = None, limit: int = 500):
+    from clip_index import images_by_classification
+    return {"images": images_by_classification(severity=severity, defect=defect, limit=limit)}
 
 @app.post("/search/images")
 async def search_images_endpoint(req: ImageSearchRequest):
-    results = search_images(req.query, k=req.k)
+    try:
+        results = await run_in_threadpool(
+            search_images, req.query, k=req.k, label=req.label, min_severity=req.min_severity,
+            min_width=req.min_width, min_height=req.min_height,
+        )
+    except ValueError as e:
+        return {"error": str(e), "images": []}
     return {"images": results}
 
+async def _scoped(stream, scope: dict):
+    # Runs the response stream inside the request's query embedding scope.
+    with query_scope(scope):
+        async for chunk in stream:
+            yield chunk
+
 @app.post("/chat/stream")
 async def chat_stream(req: ChatRequest, request: Request):
     if _llm is None:
@@ -131,8 +204,11 @@ async def chat_stream(req: ChatRequest, request: Request):
         return StreamingResponse(error_stream(), media_type="text/event-stream")
 
     start_time = time.time()
+    # The question is embedded once and reused by the cache, retrieval and tools.
+    scope = {}
     if CACHE_ENABLED:
-        cached = _cache.get(req.question)
+        with query_scope(scope):
+            cached = await run_in_threadpool(_cache.get, req.question)
         if cached:
             elapsed = int((time.time() - start_time) * 1000)
             log_interaction(
@@ -151,10 +227,23 @@ async def chat_stream(req: ChatRequest, request: Request):
         async def agent_stream():
             full_answer = ""
             final_event = None
+            done_ms = None
+            saved = False
+
+            def remember():
+                nonlocal saved
+                saved = True
+                history.append({"role": "user", "content": req.question})
+                history.append({"role": "assistant", "content": full_answer})
+                if len(history) > 12:
+                    _chat_histories[req.session_id] = history[-12:]
+                save_session_turn(req.session_id, "user", req.question)
+                save_session_turn(req.session_id, "assistant", full_answer)
+
             yield f"data: {json.dumps({'type': 'thinking', 'content': 'Planning...'})}\n\n"
 
             try:
-                for event in run_agent_turn(req.question, history, use_images=req.use_images):
+                async for event in run_agent_turn(req.question, history, use_images=req.use_images):
                     if await request.is_disconnected():
                         break
 
@@ -162,10 +251,10 @@ async def chat_stream(req: ChatRequest, request: Request):
                         yield f"data: {json.dumps({'type': 'thinking', 'content': event['content']})}\n\n"
 
                     elif event["type"] == "tool_call":
-                        yield f"data: {json.dumps({'type': 'tool_call', 'name': event['name'], 'input': event['input']})}\n\n"
+                        yield f"data: {json.dumps({'type': 'tool_call', 'id': event.get('id'), 'name': event['name'], 'input': event['input']})}\n\n"
 
                     elif event["type"] == "tool_result":
-                        yield f"data: {json.dumps({'type': 'tool_result', 'name': event['name'], 'preview': event['content'][:150]})}\n\n"
+                        yield f"data: {json.dumps({'type': 'tool_result', 'id': event.get('id'), 'name': event['name'], 'preview': event['content'][:150]})}\n\n"
 
                     elif event["type"] == "token":
                         full_answer += event["content"]
@@ -173,22 +262,27 @@ async def chat_stream(req: ChatRequest, request: Request):
 
                     elif event["type"] == "done":
                         final_event = event
+                        done_ms = int((time.time() - start_time) * 1000)
+                        # The client accepts the next question on done, while related
+                        # questions are still being generated; the turn must be saved by then.
+                        if full_answer:
+                            remember()
+                        yield f"data: {json.dumps(final_event)}\n\n"
+                        if full_answer and CACHE_ENABLED:
+                            sources = final_event.get("sources", [])
+                            await run_in_threadpool(_cache.put, req.question, full_answer, sources[:5], reports_from_sources(sources))
+
+                    elif event["type"] == "related":
+                        yield f"data: {json.dumps({'type': 'related', 'related': event['related']})}\n\n"
 
             except Exception as e:
                 yield f"data: {json.dumps({'type': 'error', 'content': str(e)})}\n\n"
 
-            if full_answer:
-                history.append({"role": "user", "content": req.question})
-                history.append({"role": "assistant", "content": full_answer})
-                if len(history) > 12:
-                    _chat_histories[req.session_id] = history[-12:]
-                save_session_turn(req.session_id, "user", req.question)
-                save_session_turn(req.session_id, "assistant", full_answer)
-                if CACHE_ENABLED:
-                    sources = final_event.get("sources", []) if final_event else []
-                    _cache.put(req.question, full_answer, sources[:5])
+            if full_answer and not saved:
+                # Stopped before done (error or disconnect): keep the partial turn, do not cache it.
+                remember()
 
-            elapsed = int((time.time() - start_time) * 1000)
+            elapsed = done_ms if done_ms is not None else int((time.time() - start_time) * 1000)
             log_interaction(
                 session_id=req.session_id, question=req.question,
                 answer=full_answer,
@@ -196,18 +290,17 @@ async def chat_stream(req: ChatRequest, request: Request):
                 cached=False, response_time_ms=elapsed,
             )
 
-            if final_event:
-                yield f"data: {json.dumps(final_event)}\n\n"
-            else:
+            if not final_event:
                 yield f"data: {json.dumps({'type': 'done', 'sources': [], 'images': [], 'related': []})}\n\n"
 
-        return StreamingResponse(agent_stream(), media_type="text/event-stream")
+        return StreamingResponse(_scoped(agent_stream(), scope), media_type="text/event-stream")
 
     else:
-        docs = retrieve(_store, req.question) if _store else []
+        with query_scope(scope):
+            docs = await run_in_threadpool(retrieve, _store, req.question) if _store else []
         sources = [d["source_label"] for d in docs]
         context = build_context_block(docs)
-        images = search_images(req.question)
+        images = await run_in_threadpool(search_images, req.question)
         image_desc = ""
         if images:
             parts = [f"- {img['label']} ({img['score']}%): {img['path']}" for img in images]
@@ -218,7 +311,7 @@ async def chat_stream(req: ChatRequest, request: Request):
         async def pipeline_stream():
             full_answer = ""
             try:
-                for chunk in _llm.stream(msgs):
+                async for chunk in _llm.astream(msgs):
                     if await request.is_disconnected():
                         break
                     token = chunk.content
@@ -236,7 +329,7 @@ async def chat_stream(req: ChatRequest, request: Request):
                 save_session_turn(req.session_id, "user", req.question)
                 save_session_turn(req.session_id, "assistant", full_answer)
                 if CACHE_ENABLED:
-                    _cache.put(req.question, full_answer, sources[:5])
+                    await run_in_threadpool(_cache.put, req.question, full_answer, sources[:5], reports_from_sources(sources))
 
             elapsed = int((time.time() - start_time) * 1000)
             log_interaction(
@@ -247,7 +340,7 @@ async def chat_stream(req: ChatRequest, request: Request):
 
             yield f"data: {json.dumps({'type': 'done', 'sources': sources[:5], 'images': images, 'related': []})}\n\n"
 
-        return StreamingResponse(pipeline_stream(), media_type="text/event-stream")
+        return StreamingResponse(_scoped(pipeline_stream(), scope), media_type="text/event-stream")
 
 @app.post("/clear")
 async def clear(session_id: str = "default"):
@@ -260,12 +353,14 @@ async def clear_cache():
     return {"status": "cache cleared"}
 
 @app.post("/rebuild-index")
-async def rebuild_index(background_tasks: BackgroundTasks):
+async def rebuild_index(background_tasks: BackgroundTasks, mode: str = "full"):
     from clip_index import _rebuild_progress
+    if mode not in ("full", "incremental"):
+        return {"error": f"Unknown mode '{mode}', use 'full' or 'incremental'"}
     if _rebuild_progress.get("running"):
         return {"error": "Rebuild already in progress"}
-    background_tasks.add_task(rebuild_clip_index)
-    return {"status": "started"}
+    background_tasks.add_task(rebuild_clip_index, mode)
+    return {"status": "started", "mode": mode}
 
 @app.get("/rebuild-progress")
 def rebuild_progress_endpoint():
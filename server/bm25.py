@@ -0,0 +1,132 @@
+import heapq
+import math
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from operator import itemgetter
+
+# Identifiers such as "DNV-RP-F116", "KP 12.450" or "W-1043" are kept whole and
+# also split into their parts, so both exact and partial mentions match.
+_TOKEN = re.compile(r"[a-z0-9]+(?:[-_./][a-z0-9]+)*")
+_SPLIT = re.compile(r"[-_./]")
+_STOPWORDS = frozenset(
+    "a an and are as at be by for from has have in is it its of on or that the this to was were what which with".split()
+)
+
+def tokenize(text: str) -> list[str]:
+    tokens = []
+    for tok in _TOKEN.findall(text.lower()):
+        if tok in _STOPWORDS:
+            continue
+        tokens.append(tok)
+        if _SPLIT.search(tok):
+            tokens.extend(p for p in _SPLIT.split(tok) if p and p not in _STOPWORDS)
+    return tokens
+
+class BM25Index:
+    """Okapi BM25 over an inverted index that supports adding and removing chunks."""
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self._postings: dict[str, dict[str, int]] = {}
+        self._lengths: dict[str, int] = {}
+        self._doc_terms: dict[str, tuple[str, ...]] = {}
+        self._total_len = 0
+        self._lock = threading.Lock()
+
+    def _remove(self, chunk_id: str):
+        terms = self._doc_terms.pop(chunk_id, None)
+        if terms is None:
+            return
+        for term in terms:
+            posting = self._postings[term]
+            del posting[chunk_id]
+            if not posting:
+                del self._postings[term]
+        self._total_len -= self._lengths.pop(chunk_id)
+
+    def add(self, ids: list[str], texts: list[str]):
+        analyzed = [Counter(tokenize(t)) for t in texts]
+        with self._lock:
+            for chunk_id, counts in zip(ids, analyzed):
+                self._remove(chunk_id)
+                for term, tf in counts.items():
+                    self._postings.setdefault(term, {})[chunk_id] = tf
+                length = sum(counts.values())
+                self._lengths[chunk_id] = length
+                self._doc_terms[chunk_id] = tuple(counts)
+                self._total_len += length
+
+    def remove(self, ids: list[str]):
+        with self._lock:
+            for chunk_id in ids:
+                self._remove(chunk_id)
+
+    def clear(self):
+        with self._lock:
+            self._postings.clear()
+            self._lengths.clear()
+            self._doc_terms.clear()
+            self._total_len = 0
+
+    def search(self, query: str, k: int) -> list[tuple[str, float]]:
+        terms = set(tokenize(query))
+        with self._lock:
+            n = len(self._lengths)
+            if not n or not terms:
+                return []
+            avgdl = self._total_len / n or 1.0
+            scores = defaultdict(float)
+            for term in terms:
+                posting = self._postings.get(term)
+                if not posting:
+                    continue
+                df = len(posting)
+                idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+                for chunk_id, tf in posting.items():
+                    norm = self.k1 * (1 - self.b + self.b * self._lengths[chunk_id] / avgdl)
+                    scores[chunk_id] += idf * tf * (self.k1 + 1) / (tf + norm)
+        return heapq.nlargest(k, scores.items(), key=itemgetter(1))
+
+    def __len__(self) -> int:
+        return len(self._lengths)
+
+    def stats(self) -> dict:
+        return {"chunks": len(self._lengths), "terms": len(self._postings)}
+
+_index = BM25Index()
+_ready = False
+
+def load_lexical_index(store, page_size: int = 5000):
+    """Build the index from every chunk in the Chroma store."""
+    global _ready
+    t0 = time.time()
+    _ready = False
+    _index.clear()
+    offset = 0
+    while True:
+        page = store.get(include=["documents"], limit=page_size, offset=offset)
+        if not page["ids"]:
+            break
+        _index.add(page["ids"], page["documents"])
+        offset += len(page["ids"])
+    _ready = True
+    print(f"Lexical index ready: {len(_index)} chunks in {time.time() - t0:.1f}s")
+
+# Ingestion calls these so the index follows the store. Before the first load
+# they are no-ops; the load reads the store as it is then.
+def index_chunks(ids: list[str], texts: list[str]):
+    if _ready:
+        _index.add(ids, texts)
+
+def remove_chunks(ids: list[str]):
+    if _ready:
+        _index.remove(ids)
+
+def lexical_search(query: str, k: int) -> list[tuple[str, float]]:
+    return _index.search(query, k) if _ready else []
+
+def lexical_index_stats() -> dict:
+    return {"ready": _ready, **_index.stats()}
@@ -1,75 +1,350 @@
+import json
+import sqlite3
+import threading
 import time
+import uuid
 import numpy as np
+from collections import OrderedDict
 from dataclasses import dataclass, field
-from config import CACHE_MAX_SIZE, CACHE_SIMILARITY_THRESHOLD
+from config import (
+    CACHE_MAX_SIZE,
+    CACHE_SIMILARITY_THRESHOLD,
+    CACHE_PERSIST,
+    CACHE_PERSIST_PATH,
+    CACHE_COMPACT_INTERVAL,
+    CACHE_TTL,
+    EMBEDDING_MODEL,
+)
+from query_embeddings import embed_query, get_query_embedder
 
 @dataclass
 class CacheEntry:
     question: str
     answer: str
     sources: list[str]
-    embedding: np.ndarray
     timestamp: float = field(default_factory=time.time)
     hits: int = 0
+    last_used: float = field(default_factory=time.time)
+    entry_id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    # What the answer was built from: content hash of each cited report, plus
+    # the corpus and image index versions at the time.
+    reports: dict[str, str] = field(default_factory=dict)
+    corpus_version: str | None = None
+    index_version: str | None = None
+
+def reports_from_sources(sources: list[str]) -> list[str]:
+    # Source labels look like "<report> s.<page>".
+    return sorted({s.rsplit(" s.", 1)[0] for s in sources if s})
+
+def _current_versions() -> tuple[dict, str | None, str | None]:
+    try:
+        from vectorstore import report_versions, corpus_version
+        reports, corpus = report_versions(), corpus_version()
+    except Exception:
+        reports, corpus = {}, None
+    try:
+        from clip_index import index_version
+        index = index_version()
+    except Exception:
+        index = None
+    return reports, corpus, index
+
+_COLUMNS = {
+    "corpus_version": "TEXT",
+    "index_version": "TEXT",
+    "reports": "TEXT NOT NULL DEFAULT '{}'",
+}
+
+def _get_conn(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS semantic_cache (
+            entry_id TEXT PRIMARY KEY,
+            model TEXT NOT NULL,
+            question TEXT NOT NULL,
+            answer TEXT NOT NULL,
+            sources TEXT NOT NULL,
+            embedding BLOB NOT NULL,
+            timestamp REAL NOT NULL,
+            last_used REAL NOT NULL,
+            hits INTEGER DEFAULT 0
+        )
+    """)
+    existing = {row[1] for row in conn.execute("PRAGMA table_info(semantic_cache)")}
+    for name, decl in _COLUMNS.items():
+        if name not in existing:
+            conn.execute(f"ALTER TABLE semantic_cache ADD COLUMN {name} {decl}")
+    return conn
 
 class SemanticCache:
-    def __init__(self):
-        self._entries: list[CacheEntry] = []
-        self._embedder = None
+    # Entry i's normalized embedding is row i of _matrix, so a lookup is one
+    # matmul over the filled rows. Evicted rows are reused in place; rows freed
+    # by invalidation are zeroed (never above the threshold) until reused.
+    def __init__(self, max_size: int = CACHE_MAX_SIZE, persist_path: str = CACHE_PERSIST_PATH if CACHE_PERSIST else None,
+                 ttl: float = CACHE_TTL):
+        self.max_size = max_size
+        self.persist_path = persist_path
+        self.ttl = ttl
+        self._entries: list[CacheEntry | None] = []
+        self._matrix: np.ndarray | None = None
+        self._lru: OrderedDict = OrderedDict()
+        self._free: list[int] = []
+        self._lock = threading.Lock()
+        # Hit counts and evictions reach SQLite at the next compaction.
+        self._touched: set[str] = set()
+        self._evicted: set[str] = set()
+        self._compactor = None
+        self._stop = threading.Event()
+        self.hits = 0
+        self.misses = 0
+        self.invalidated = 0
 
-    def _get_embedder(self):
-        if self._embedder is None:
-            from vectorstore import get_embeddings
-            self._embedder = get_embeddings()
-        return self._embedder
+    def warm_up(self):
+        get_query_embedder().embed_query("warm up")
 
     def _embed(self, text: str) -> np.ndarray:
-        vec = self._get_embedder().embed_query(text)
-        return np.array(vec)
+        vec = np.asarray(embed_query(text), dtype=np.float32)
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm else vec
+
+    def _release(self, row: int):
+        entry = self._entries[row]
+        self._evicted.add(entry.entry_id)
+        self._touched.discard(entry.entry_id)
+        self._entries[row] = None
+        self._matrix[row] = 0.0
+        self._lru.pop(row, None)
+        self._free.append(row)
 
-    def _cosine_sim(self, a: np.ndarray, b: np.ndarray) -> float:
-        dot = np.dot(a, b)
-        norm = np.linalg.norm(a) * np.linalg.norm(b)
-        if norm == 0:
-            return 0.0
-        return float(dot / norm)
+    def _row_for_new_entry(self, dim: int) -> int:
+        if self._free:
+            return self._free.pop()
+        n = len(self._entries)
+        if n >= self.max_size:
+            row = next(iter(self._lru))
+            self._release(row)
+            return self._free.pop()
+        if self._matrix is None:
+            self._matrix = np.zeros((min(self.max_size, 64), dim), dtype=np.float32)
+        elif n == len(self._matrix):
+            grown = np.zeros((min(self.max_size, 2 * n), dim), dtype=np.float32)
+            grown[:n] = self._matrix
+            self._matrix = grown
+        self._entries.append(None)
+        return n
+
+    def _insert(self, entry: CacheEntry, emb: np.ndarray):
+        row = self._row_for_new_entry(len(emb))
+        self._matrix[row] = emb
+        self._entries[row] = entry
+        self._lru[row] = None
+
+    def _is_fresh(self, entry: CacheEntry, versions: tuple, now: float) -> bool:
+        reports, corpus, index = versions
+        if self.ttl and now - entry.timestamp > self.ttl:
+            return False
+        if entry.index_version != index:
+            return False
+        if entry.reports:
+            return all(reports.get(r) == h for r, h in entry.reports.items())
+        # An answer citing nothing may change with any new report.
+        return entry.corpus_version == corpus
 
     def get(self, question: str) -> dict | None:
-        if not self._entries:
+        if not self.size:
+            self.misses += 1
             return None
 
         q_emb = self._embed(question)
-        best_sim = 0.0
-        best_entry = None
-
-        for entry in self._entries:
-            sim = self._cosine_sim(q_emb, entry.embedding)
-            if sim > best_sim:
-                best_sim = sim
-                best_entry = entry
-
-        if best_sim >= CACHE_SIMILARITY_THRESHOLD and best_entry:
-            best_entry.hits += 1
-            print(f"Cache hit (sim={best_sim:.3f}, hits={best_entry.hits}): {question[:60]}")
-            return {"answer": best_entry.answer, "sources": best_entry.sources}
-        return None
-
-    def put(self, question: str, answer: str, sources: list[str]):
+        versions = _current_versions()
+        with self._lock:
+            n = len(self._entries)
+            if not n:
+                self.misses += 1
+                return None
+            sims = self._matrix[:n] @ q_emb
+            # Best match first among those above the threshold; stale ones are
+            # evicted on the way so they cannot hide a fresh hit behind them.
+            candidates = np.flatnonzero(sims >= CACHE_SIMILARITY_THRESHOLD)
+            now = time.time()
+            entry = None
+            for row in candidates[np.argsort(sims[candidates])[::-1]]:
+                row = int(row)
+                found = self._entries[row]
+                if found is None:
+                    continue
+                if self._is_fresh(found, versions, now):
+                    entry, best, best_sim = found, row, float(sims[row])
+                    break
+                self._release(row)
+                self.invalidated += 1
+                print(f"Cache entry stale, evicted: {found.question[:60]}")
+            if entry is None:
+                self.misses += 1
+                return None
+            entry.hits += 1
+            entry.last_used = now
+            self._lru.move_to_end(best)
+            self._touched.add(entry.entry_id)
+            self.hits += 1
+        print(f"Cache hit (sim={best_sim:.3f}, hits={entry.hits}): {question[:60]}")
+        return {"answer": entry.answer, "sources": entry.sources}
+
+    def put(self, question: str, answer: str, sources: list[str], reports: list[str] = None):
+        """Cache an answer; reports defaults to the reports named in sources."""
+        if self.max_size <= 0:
+            return
         q_emb = self._embed(question)
-        if len(self._entries) >= CACHE_MAX_SIZE:
-            self._entries.sort(key=lambda e: e.timestamp)
-            self._entries.pop(0)
-
-        self._entries.append(CacheEntry(
-            question=question,
-            answer=answer,
-            sources=sources,
-            embedding=q_emb,
-        ))
-        print(f"Cached: {question[:60]} (total: {len(self._entries)})")
+        current, corpus, index = _current_versions()
+        cited = reports_from_sources(sources) if reports is None else reports
+        entry = CacheEntry(
+            question=question, answer=answer, sources=sources,
+            reports={r: current[r] for r in cited if r in current},
+            corpus_version=corpus, index_version=index,
+        )
+        with self._lock:
+            self._insert(entry, q_emb)
+            total = self.size
+        if self.persist_path:
+            self._write_through(entry, q_emb)
+        print(f"Cached: {question[:60]} (total: {total})")
+
+    def invalidate_reports(self, reports: set[str]) -> int:
+        """Evict entries that cite any of reports, and entries that cite none."""
+        with self._lock:
+            stale = [
+                row for row, e in enumerate(self._entries)
+                if e is not None and (not e.reports or not reports.isdisjoint(e.reports))
+            ]
+            for row in stale:
+                self._release(row)
+            self.invalidated += len(stale)
+        if stale:
+            print(f"Cache: evicted {len(stale)} entries depending on {len(reports)} changed reports")
+        return len(stale)
 
     def clear(self):
-        self._entries.clear()
+        with self._lock:
+            self._entries.clear()
+            self._lru.clear()
+            self._free.clear()
+            self._matrix = None
+            self._touched.clear()
+            self._evicted.clear()
+        if self.persist_path:
+            try:
+                conn = _get_conn(self.persist_path)
+                conn.execute("DELETE FROM semantic_cache")
+                conn.commit()
+                conn.close()
+            except Exception as e:
+                print(f"Semantic cache clear failed: {e}")
+
     @property
     def size(self) -> int:
-        return len(self._entries)
\ No newline at end of file
+        return len(self._entries) - len(self._free)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": self.size,
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+            "invalidated": self.invalidated,
+            "ttl": self.ttl,
+        }
+
+    def _write_through(self, entry: CacheEntry, emb: np.ndarray):
+        try:
+            conn = _get_conn(self.persist_path)
+            conn.execute(
+                "INSERT OR REPLACE INTO semantic_cache "
+                "(entry_id, model, question, answer, sources, embedding, timestamp, last_used, hits, "
+                "corpus_version, index_version, reports) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (entry.entry_id, EMBEDDING_MODEL, entry.question, entry.answer, json.dumps(entry.sources),
+                 emb.astype(np.float32).tobytes(), entry.timestamp, entry.last_used, entry.hits,
+                 entry.corpus_version, entry.index_version, json.dumps(entry.reports)),
+            )
+            conn.commit()
+            conn.close()
+        except Exception as e:
+            print(f"Semantic cache write failed: {e}")
+
+    def load(self):
+        """Restore persisted entries, most recently used last so LRU order survives.
+
+        Entries made stale while the server was down are dropped here.
+        """
+        if not self.persist_path:
+            return
+        try:
+            conn = _get_conn(self.persist_path)
+            rows = conn.execute(
+                "SELECT entry_id, question, answer, sources, embedding, timestamp, last_used, hits, "
+                "reports, corpus_version, index_version "
+                "FROM semantic_cache WHERE model = ? ORDER BY last_used DESC LIMIT ?",
+                (EMBEDDING_MODEL, self.max_size),
+            ).fetchall()
+            conn.close()
+        except Exception as e:
+            print(f"Semantic cache load failed: {e}")
+            return
+        versions = _current_versions()
+        now = time.time()
+        loaded = 0
+        with self._lock:
+            for row in reversed(rows):
+                entry_id, question, answer, sources, emb, timestamp, last_used, hits, reports, corpus, index = row
+                entry = CacheEntry(question, answer, json.loads(sources), timestamp, hits, last_used, entry_id,
+                                   json.loads(reports), corpus, index)
+                if not self._is_fresh(entry, versions, now):
+                    self._evicted.add(entry_id)
+                    continue
+                self._insert(entry, np.frombuffer(emb, dtype=np.float32))
+                loaded += 1
+        print(f"Semantic cache loaded: {loaded} entries ({len(rows) - loaded} stale)")
+
+    def compact(self):
+        """Flush hit counts, drop evicted rows and anything beyond max_size or from another model."""
+        if not self.persist_path:
+            return
+        with self._lock:
+            touched = [(e.hits, e.last_used, e.entry_id) for e in self._entries if e and e.entry_id in self._touched]
+            evicted = [(i,) for i in self._evicted]
+            self._touched.clear()
+            self._evicted.clear()
+        try:
+            conn = _get_conn(self.persist_path)
+            conn.executemany("UPDATE semantic_cache SET hits = ?, last_used = ? WHERE entry_id = ?", touched)
+            conn.executemany("DELETE FROM semantic_cache WHERE entry_id = ?", evicted)
+            conn.execute("DELETE FROM semantic_cache WHERE model != ?", (EMBEDDING_MODEL,))
+            if self.ttl:
+                conn.execute("DELETE FROM semantic_cache WHERE timestamp < ?", (time.time() - self.ttl,))
+            conn.execute(
+                "DELETE FROM semantic_cache WHERE entry_id NOT IN "
+                "(SELECT entry_id FROM semantic_cache ORDER BY last_used DESC LIMIT ?)",
+                (self.max_size,),
+            )
+            removed = conn.total_changes - len(touched)
+            conn.commit()
+            if removed > self.max_size // 4:
+                conn.execute("VACUUM")
+            conn.close()
+        except Exception as e:
+            print(f"Semantic cache compaction failed: {e}")
+
+    def _compact_loop(self):
+        while not self._stop.wait(CACHE_COMPACT_INTERVAL):
+            self.compact()
+
+    def start_compaction(self):
+        if self.persist_path and self._compactor is None:
+            self._compactor = threading.Thread(target=self._compact_loop, name="cache-compact", daemon=True)
+            self._compactor.start()
+
+    def close(self):
+        self._stop.set()
+        self.compact()
@@ -0,0 +1,68 @@
+import json
+import sqlite3
+import time
+from config import CLASSIFY_CACHE_PATH, CLASSIFY_CACHE_MEMORY_SIZE
+from lru import LRUCache
+
+# Recent results are served from memory; SQLite keeps them across restarts.
+_memory = LRUCache(CLASSIFY_CACHE_MEMORY_SIZE)
+
+def _get_conn() -> sqlite3.Connection:
+    conn = sqlite3.connect(CLASSIFY_CACHE_PATH)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS classifications (
+            image_hash TEXT NOT NULL,
+            fingerprint TEXT NOT NULL,
+            result TEXT NOT NULL,
+            timestamp REAL NOT NULL,
+            PRIMARY KEY (image_hash, fingerprint)
+        )
+    """)
+    return conn
+
+def get_classification(image_hash: str, fingerprint: str) -> dict | None:
+    key = (image_hash, fingerprint)
+    raw = _memory.get(key)
+    if raw is None:
+        try:
+            conn = _get_conn()
+            row = conn.execute(
+                "SELECT result FROM classifications WHERE image_hash = ? AND fingerprint = ?",
+                (image_hash, fingerprint),
+            ).fetchone()
+            conn.close()
+        except Exception as e:
+            print(f"Classification cache read failed: {e}")
+            return None
+        if row is None:
+            return None
+        raw = row[0]
+        _memory.put(key, raw)
+    return json.loads(raw)
+
+def put_classification(image_hash: str, fingerprint: str, result: dict):
+    raw = json.dumps(result)
+    _memory.put((image_hash, fingerprint), raw)
+    try:
+        conn = _get_conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO classifications (image_hash, fingerprint, result, timestamp) VALUES (?, ?, ?, ?)",
+            (image_hash, fingerprint, raw, time.time()),
+        )
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        print(f"Classification cache write failed: {e}")
+
+def clear_classifications():
+    _memory.clear()
+    try:
+        conn = _get_conn()
+        conn.execute("DELETE FROM classifications")
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        print(f"Classification cache clear failed: {e}")
+
+def classification_cache_stats() -> dict:
+    return _memory.stats()
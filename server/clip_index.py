@@ -1,19 +1,49 @@
+import io
+import os
 import pickle
 import glob
+import hashlib
 import json
+import sqlite3
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-import torch
-import torch.nn as nn
 import numpy as np
 from PIL import Image
-from torchvision import transforms, models
-from config import IMAGES_DIR, CLIP_INDEX_PATH, CLIP_MODEL, TOP_K_IMAGES
-_model = None
-_processor = None
+from config import (
+    IMAGES_DIR,
+    CLIP_INDEX_PATH,
+    CLIP_INDEX_DIR,
+    CLIP_INDEX_FP16,
+    CLIP_MODEL,
+    TOP_K_IMAGES,
+    CLIP_BATCH_SIZE,
+    CLIP_INDEX_WORKERS,
+    CLIP_SEARCH_BACKEND,
+    ANN_MIN_SIZE,
+    ANN_NLIST,
+    ANN_NPROBE,
+    CLIP_QUERY_CACHE_SIZE,
+    INFERENCE_BACKEND,
+    ONNX_QUANTIZE,
+)
+from lru import LRUCache
+from classify_cache import get_classification, put_classification
+from search_backend import ExactBackend, IVFBackend
+from models import register_model, get_model, using
 _index = None
-_classifier = None
-_classifier_classes = None
-_rebuild_progress: dict = {"running": False, "indexed": 0, "total": 0, "done": True, "error": None}
+_index_stamp = None
+_backend = None
+# Text embeddings depend only on the query; results also on k and the index version,
+# so a rebuilt index never serves stale hits.
+_text_emb_cache = LRUCache(CLIP_QUERY_CACHE_SIZE)
+_result_cache = LRUCache(CLIP_QUERY_CACHE_SIZE)
+_text_bank = None
+_text_bank_model = None
+_prompt_fp = None
+_rebuild_progress: dict = {"running": False, "indexed": 0, "total": 0, "done": True, "error": None, "images_per_sec": None}
 
 CLIP_SIM_MIN = 0.15
 CLIP_SIM_MAX = 0.40
@@ -174,45 +204,118 @@ def _normalize_score(raw: float) -> int:
     pct = (clamped - CLIP_SIM_MIN) / (CLIP_SIM_MAX - CLIP_SIM_MIN)
     return int(round(pct * 100))
 
+def _load_clip_model():
+    from transformers import CLIPProcessor
+    print(f"   Loading CLIP model: {CLIP_MODEL} ({INFERENCE_BACKEND})")
+    if INFERENCE_BACKEND == "onnx":
+        from onnx_backend import OnnxClip
+        model = OnnxClip(CLIP_MODEL)
+    else:
+        from transformers import CLIPModel
+        model = CLIPModel.from_pretrained(CLIP_MODEL)
+    processor = CLIPProcessor.from_pretrained(CLIP_MODEL)
+    print("   CLIP ready")
+    return model, processor
+
+register_model("clip", _load_clip_model)
+
 def _load_clip():
-    global _model, _processor
-    if _model is None:
-        from transformers import CLIPModel, CLIPProcessor
-        print(f"   Loading CLIP model: {CLIP_MODEL}")
-        _model = CLIPModel.from_pretrained(CLIP_MODEL)
-        _processor = CLIPProcessor.from_pretrained(CLIP_MODEL)
-        print("   CLIP ready")
-    return _model, _processor
+    return get_model("clip")
 
-def _load_classifier():
-    global _classifier, _classifier_classes
-    if _classifier is not None:
-        return _classifier, _classifier_classes
+def warm_up_clip():
+    # One dummy pass so the first request does not pay for kernel selection,
+    # and the prompt bank is ready before classification is needed.
+    model, processor = _load_clip()
+    _get_text_bank(model, processor)
+    _encode_image(model, processor, Image.new("RGB", (224, 224)))
 
+def _load_classifier_model():
     model_path = Path(__file__).parent / "defect_model" / "efficientnet_b0.pth"
     meta_path = Path(__file__).parent / "defect_model" / "meta.json"
 
     if model_path.exists() and meta_path.exists():
         try:
+            import torch
+            import torch.nn as nn
+            from torchvision import models
             with open(meta_path) as f:
                 meta = json.load(f)
-            _classifier_classes = meta["classes"]
+            classes = meta["classes"]
             model = models.efficientnet_b0(weights=None)
-            model.classifier[1] = nn.Linear(model.classifier[1].in_features, len(_classifier_classes))
+            model.classifier[1] = nn.Linear(model.classifier[1].in_features, len(classes))
             model.load_state_dict(torch.load(model_path, map_location="cpu", weights_only=True))
             model.eval()
-            _classifier = model
-            print(f"Loaded fine-tuned classifier: {len(_classifier_classes)} classes")
-            return _classifier, _classifier_classes
+            print(f"Loaded fine-tuned classifier: {len(classes)} classes")
+            return model, classes
         except Exception as e:
             print(f"Could not load classifier: {e}")
 
     return None, None
 
-def _caption_image(model, processor, img):
+register_model("defect_classifier", _load_classifier_model)
+
+def _load_classifier():
+    return get_model("defect_classifier")
+
+def _features(out) -> np.ndarray:
+    if isinstance(out, np.ndarray):
+        return out
+    import torch
+    # transformers>=5 returns a model output whose pooler_output holds the projection.
+    if not isinstance(out, torch.Tensor):
+        out = out.pooler_output
+    return out.detach().numpy()
+
+def _logit_scale(model) -> float:
+    scale = model.logit_scale
+    if hasattr(scale, "detach"):
+        scale = scale.detach().item()
+    return float(np.exp(scale))
+
+def _encode_texts(model, processor, texts: list[str]) -> np.ndarray:
+    import torch
+    inputs = processor(text=texts, return_tensors="pt", padding=True, truncation=True)
+    with torch.no_grad():
+        feats = _features(model.get_text_features(**inputs))
+    return feats / np.linalg.norm(feats, axis=1, keepdims=True)
+
+def _encode_image(model, processor, img) -> np.ndarray:
+    import torch
+    inputs = processor(images=img, return_tensors="pt")
+    with torch.no_grad():
+        emb = _features(model.get_image_features(**inputs)).flatten()
+    return emb / np.linalg.norm(emb)
+
+def _ensemble_bank(model, processor, ensemble: list[dict]) -> dict:
+    prompts = [p for cls in ensemble for p in cls["prompts"]]
+    owner = np.repeat(np.arange(len(ensemble)), [len(cls["prompts"]) for cls in ensemble])
+    # prompt logits @ pool gives the mean logit per class
+    pool = np.zeros((len(prompts), len(ensemble)), dtype=np.float32)
+    pool[np.arange(len(prompts)), owner] = 1.0
+    pool /= pool.sum(axis=0, keepdims=True)
+    return {"matrix": _encode_texts(model, processor, prompts), "pool": pool}
+
+def _get_text_bank(model, processor) -> dict:
+    # The prompt sets are fixed, so they are encoded once per loaded model and kept
+    # as normalized matrices; classification is then one image encode plus matmuls.
+    global _text_bank, _text_bank_model
+    # Keyed by id so the bank does not keep an unloaded model alive.
+    if _text_bank is None or _text_bank_model != id(model):
+        _text_bank = {
+            "scale": _logit_scale(model),
+            "defect": _ensemble_bank(model, processor, _DEFECT_ENSEMBLE),
+            "severity": _ensemble_bank(model, processor, _SEVERITY_ENSEMBLE),
+            "captions": _encode_texts(model, processor, CLIP_CAPTIONS),
+        }
+        _text_bank_model = id(model)
+    return _text_bank
+
+def _caption_image(model, processor, img, emb: np.ndarray = None):
     classifier, classes = _load_classifier()
     if classifier is not None:
         try:
+            import torch
+            from torchvision import transforms
             transform = transforms.Compose([
                 transforms.Resize((224, 224)),
                 transforms.ToTensor(),
@@ -228,173 +331,764 @@ def _caption_image(model, processor, img):
             pass
 
     try:
-        inputs = processor(text=CLIP_CAPTIONS, images=img, return_tensors="pt", padding=True, truncation=True)
-        with torch.no_grad():
-            outputs = model(**inputs)
-        logits = outputs.logits_per_image.detach().numpy().flatten()
-        return CLIP_CAPTIONS[logits.argmax()]
+        if emb is None:
+            emb = _encode_image(model, processor, img)
+        bank = _get_text_bank(model, processor)
+        return CLIP_CAPTIONS[int((bank["captions"] @ emb).argmax())]
     except Exception:
         return "inspection image"
 
-def _ensemble_classify(model, processor, img, ensemble: list[dict]) -> list[tuple]:
-    class_scores = []
-    for cls in ensemble:
-        inputs = processor(
-            text=cls["prompts"], images=img,
-            return_tensors="pt", padding=True, truncation=True,
-        )
-        with torch.no_grad():
-            outputs = model(**inputs)
-        logits = outputs.logits_per_image.detach().numpy().flatten()
-        class_scores.append(float(logits.mean()))
+def _ensemble_probs(emb: np.ndarray, bank: dict, scale: float) -> np.ndarray:
+    # Mean logit over each class's phrasings, then softmax across classes.
+    # Works for a single embedding or a batch of row embeddings.
+    class_scores = (scale * (emb @ bank["matrix"].T)) @ bank["pool"]
+    exp = np.exp(class_scores - class_scores.max(axis=-1, keepdims=True))
+    return exp / exp.sum(axis=-1, keepdims=True)
 
-    arr = np.array(class_scores)
-    exp = np.exp(arr - arr.max())
-    probs = (exp / exp.sum()).tolist()
-    return list(zip(ensemble, probs))
+def _classify_embedding(model, processor, emb: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    bank = _get_text_bank(model, processor)
+    defect_probs = _ensemble_probs(emb, bank["defect"], bank["scale"])
+    sev_probs = _ensemble_probs(emb, bank["severity"], bank["scale"])
+    return defect_probs, sev_probs
 
-
-def classify_image(img) -> dict:
+def _score_embeddings(embeddings) -> tuple[np.ndarray, np.ndarray]:
     model, processor = _load_clip()
+    defect, severity = [], []
+    for start in range(0, len(embeddings), 65536):
+        block = np.asarray(embeddings[start:start + 65536], dtype=np.float32)
+        d, sv = _classify_embedding(model, processor, block)
+        defect.append(d)
+        severity.append(sv)
+    return (np.concatenate(defect).astype(np.float32),
+            np.concatenate(severity).astype(np.float32))
 
-    defect_ranked = sorted(
-        _ensemble_classify(model, processor, img, _DEFECT_ENSEMBLE),
-        key=lambda x: x[1], reverse=True,
-    )
-    sev_ranked = sorted(
-        _ensemble_classify(model, processor, img, _SEVERITY_ENSEMBLE),
-        key=lambda x: x[1], reverse=True,
-    )
+def _format_classification(defect_probs, sev_probs) -> dict:
+    defect_ranked = sorted(zip(_DEFECT_ENSEMBLE, defect_probs), key=lambda x: x[1], reverse=True)
+    sev_ranked = sorted(zip(_SEVERITY_ENSEMBLE, sev_probs), key=lambda x: x[1], reverse=True)
 
     top_sev = sev_ranked[0][0]
     return {
-        "defects": [{"type": cls["label"], "prob": round(p * 100)} for cls, p in defect_ranked[:3]],
+        "defects": [{"type": cls["label"], "prob": round(float(p) * 100)} for cls, p in defect_ranked[:3]],
         "severity": top_sev["key"],
-        "severity_prob": round(sev_ranked[0][1] * 100),
+        "severity_prob": round(float(sev_ranked[0][1]) * 100),
         "recommendation": top_sev["action"],
         "top_defect": defect_ranked[0][0]["label"],
     }
 
-def build_clip_index():
-    global _index
+def classify_image(img) -> dict:
     model, processor = _load_clip()
+    emb = _encode_image(model, processor, img)
+    return _format_classification(*_classify_embedding(model, processor, emb))
+
+def _prompt_fingerprint() -> str:
+    # Identifies the model, backend and prompt sets a stored classification was computed with.
+    global _prompt_fp
+    if _prompt_fp is None:
+        backend = f"onnx-{'int8' if ONNX_QUANTIZE else 'fp32'}" if INFERENCE_BACKEND == "onnx" else INFERENCE_BACKEND
+        spec = json.dumps({"model": CLIP_MODEL, "backend": backend, "defect": _DEFECT_ENSEMBLE,
+                           "severity": _SEVERITY_ENSEMBLE}, sort_keys=True)
+        _prompt_fp = hashlib.sha1(spec.encode("utf-8")).hexdigest()
+    return _prompt_fp
+
+def classify_image_bytes(data: bytes) -> dict:
+    image_hash = _file_hash(data)
+    fingerprint = _prompt_fingerprint()
+    cached = get_classification(image_hash, fingerprint)
+    if cached is not None:
+        return cached
+
+    img = Image.open(io.BytesIO(data)).convert("RGB")
+    result = classify_image(img)
+    put_classification(image_hash, fingerprint, result)
+    return result
+
+def _file_hash(data: bytes) -> str:
+    return hashlib.sha1(data).hexdigest()
+
+def _decode_for_index(img_path: str, processor, keep_image: bool):
+    try:
+        st = os.stat(img_path)
+        data = Path(img_path).read_bytes()
+        img = Image.open(io.BytesIO(data)).convert("RGB")
+        pixels = processor(images=img, return_tensors="pt")["pixel_values"][0]
+        entry = {"size": st.st_size, "mtime": st.st_mtime, "hash": _file_hash(data)}
+        # Full frames are not kept across a batch; the classifier only needs 224x224
+        # (its own Resize is then a no-op), and CLIP captioning uses the embedding.
+        small = img.resize((224, 224), Image.BILINEAR) if keep_image else None
+        return img_path, small, img.size, pixels, entry, None
+    except Exception as e:
+        return img_path, None, None, None, None, e
+
+def _iter_decoded_batches(image_paths: list[str], processor, batch_size: int, workers: int, keep_image: bool):
+    # Decoding and resizing run on the pool; the next batch is submitted before
+    # the current one is handed to CLIP so decode overlaps with the forward pass.
+    batches = [image_paths[i:i + batch_size] for i in range(0, len(image_paths), batch_size)]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for batch in batches:
+            pending.append([pool.submit(_decode_for_index, p, processor, keep_image) for p in batch])
+            if len(pending) > 1:
+                yield [f.result() for f in pending.popleft()]
+        while pending:
+            yield [f.result() for f in pending.popleft()]
+
+def _scan_images() -> list[str]:
     image_extensions = ["*.jpg", "*.jpeg", "*.png", "*.bmp", "*.webp"]
     image_paths = []
     for ext in image_extensions:
         image_paths.extend(glob.glob(str(Path(IMAGES_DIR) / "**" / ext), recursive=True))
+    return image_paths
 
-    if not image_paths:
-        print(f"   No images found in {IMAGES_DIR}")
-        _index = {"paths": [], "embeddings": np.array([]), "labels": [], "dimensions": []}
-        return _index
+def _empty_index() -> dict:
+    return {
+        "paths": [], "embeddings": np.array([]), "labels": [], "dimensions": [], "files": [],
+        "defect_probs": np.zeros((0, len(_DEFECT_ENSEMBLE)), dtype=np.float32),
+        "severity_probs": np.zeros((0, len(_SEVERITY_ENSEMBLE)), dtype=np.float32),
+    }
 
-    print(f"   Indexing {len(image_paths)} images")
+def _embed_images(image_paths: list[str]) -> dict:
+    # Indexing can outlast MODEL_IDLE_UNLOAD; keep CLIP registered meanwhile.
+    with using("clip"):
+        return _embed_image_batches(image_paths)
+
+def _embed_image_batches(image_paths: list[str]) -> dict:
+    import torch
+    model, processor = _load_clip()
+    batch_size = max(1, CLIP_BATCH_SIZE)
+    workers = max(1, CLIP_INDEX_WORKERS)
+    print(f"   Indexing {len(image_paths)} images (batch {batch_size}, {workers} workers)")
     _rebuild_progress["total"] = len(image_paths)
 
     embeddings = []
     valid_paths = []
     labels = []
     dimensions = []
-    for i, img_path in enumerate(image_paths):
-        try:
-            img = Image.open(img_path).convert("RGB")
-            w, h = img.size
-            inputs = processor(images=img, return_tensors="pt")
-            with torch.no_grad():
-                outputs = model.get_image_features(**inputs)
-            emb = outputs.detach().numpy().flatten()
-            emb = emb / np.linalg.norm(emb)
-            embeddings.append(emb)
-            valid_paths.append(img_path)
-            dimensions.append((w, h))
-            labels.append(_caption_image(model, processor, img))
-            _rebuild_progress["indexed"] = i + 1
-
-            if (i + 1) % 50 == 0:
-                print(f"   {i + 1}/{len(image_paths)} images indexed")
-        except Exception as e:
-            print(f"Error with {img_path}: {e}")
+    files = []
+    defect_probs = []
+    severity_probs = []
+    processed = 0
+    next_report = 50
+    start = time.time()
+    failed = {}
+    keep_image = _load_classifier()[0] is not None
+    for batch in _iter_decoded_batches(image_paths, processor, batch_size, workers, keep_image):
+        decoded = []
+        for img_path, img, size, pixels, entry, err in batch:
+            if err is not None:
+                print(f"Error with {img_path}: {err}")
+                failed[img_path] = _failure_entry(img_path, err)
+            else:
+                decoded.append((img_path, img, size, pixels, entry))
+
+        if decoded:
+            try:
+                pixel_values = torch.stack([item[3] for item in decoded])
+                with torch.no_grad():
+                    feats = _features(model.get_image_features(pixel_values=pixel_values))
+                feats = feats / np.linalg.norm(feats, axis=1, keepdims=True)
+                batch_defect, batch_severity = _classify_embedding(model, processor, feats)
+                defect_probs.extend(batch_defect)
+                severity_probs.extend(batch_severity)
+                for (img_path, img, size, _, entry), emb in zip(decoded, feats):
+                    embeddings.append(emb)
+                    valid_paths.append(img_path)
+                    dimensions.append(size)
+                    labels.append(_caption_image(model, processor, img, emb))
+                    files.append(entry)
+            except Exception as e:
+                print(f"Error with batch starting at {decoded[0][0]}: {e}")
+                for img_path, *_, entry in decoded:
+                    failed[img_path] = {**entry, "error": str(e)}
+
+        processed += len(batch)
+        _rebuild_progress["indexed"] = processed
+        if processed >= next_report:
+            print(f"   {processed}/{len(image_paths)} images indexed")
+            next_report = (processed // 50 + 1) * 50
+
+    elapsed = time.time() - start
+    rate = len(valid_paths) / elapsed if elapsed > 0 else 0.0
+    _rebuild_progress["images_per_sec"] = round(rate, 1)
+    print(f"   Embedded {len(valid_paths)} images in {elapsed:.1f}s ({rate:.1f} images/sec)")
 
-    _index = {
+    return {
         "paths": valid_paths,
         "embeddings": np.array(embeddings) if embeddings else np.array([]),
         "labels": labels,
         "dimensions": dimensions,
+        "files": files,
+        "defect_probs": np.array(defect_probs, dtype=np.float32).reshape(-1, len(_DEFECT_ENSEMBLE)),
+        "severity_probs": np.array(severity_probs, dtype=np.float32).reshape(-1, len(_SEVERITY_ENSEMBLE)),
+        "failed": {p: e for p, e in failed.items() if e},
+    }
+
+# On-disk layout (CLIP_INDEX_DIR):
+#   embeddings-<version>.npy  row-aligned embedding matrix, opened with mmap so
+#                             every worker shares the same page-cache pages
+#   defect_probs-<version>.npy, severity_probs-<version>.npy
+#                             per-image class probabilities precomputed from
+#                             the embeddings for the current prompt sets
+#   meta.sqlite               one row per image plus an info table that names
+#                             the current column files
+# meta.sqlite is swapped in last, so readers never see a half-written index.
+def _meta_path() -> Path:
+    return Path(CLIP_INDEX_DIR) / "meta.sqlite"
+
+def _meta_stamp():
+    try:
+        st = _meta_path().stat()
+        return st.st_mtime_ns, st.st_size
+    except OSError:
+        return None
+
+def _save_index(index: dict):
+    global _index_stamp
+    store = Path(CLIP_INDEX_DIR)
+    store.mkdir(parents=True, exist_ok=True)
+    version = str(time.time_ns())
+    emb_name = f"embeddings-{version}.npy"
+
+    emb = np.asarray(index["embeddings"], dtype=np.float32)
+    if len(index["paths"]) == 0:
+        emb = np.zeros((0, 0), dtype=np.float32)
+    if CLIP_INDEX_FP16:
+        emb = emb.astype(np.float16)
+    np.save(store / emb_name, emb)
+    score_info = _write_scores(store, version, index)
+    # Trained here rather than on the first search, so no request pays for it
+    # and every worker finds the lists ready when it sees the new version.
+    ivf_name = f"ivf-{version}.npz"
+    if _uses_ivf(len(index["paths"])):
+        _train_ivf(emb, store / ivf_name)
+
+    tmp_meta = store / f"meta-{version}.sqlite.tmp"
+    conn = sqlite3.connect(tmp_meta)
+    conn.execute("CREATE TABLE info (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+    conn.execute("""
+        CREATE TABLE images (
+            pos INTEGER PRIMARY KEY,
+            path TEXT NOT NULL,
+            label TEXT NOT NULL,
+            width INTEGER,
+            height INTEGER,
+            size INTEGER,
+            mtime REAL,
+            hash TEXT
+        )
+    """)
+    files = index.get("files") or [None] * len(index["paths"])
+    rows = []
+    for i, path in enumerate(index["paths"]):
+        w, h = index["dimensions"][i]
+        entry = files[i] or {}
+        rows.append((i, path, index["labels"][i], int(w), int(h),
+                     entry.get("size"), entry.get("mtime"), entry.get("hash")))
+    conn.executemany("INSERT INTO images VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+    conn.executemany("INSERT INTO info VALUES (?, ?)", [
+        ("version", version),
+        ("embeddings_file", emb_name),
+        ("count", str(len(rows))),
+        ("dtype", str(emb.dtype)),
+        *score_info.items(),
+    ])
+    conn.commit()
+    conn.close()
+    os.replace(tmp_meta, _meta_path())
+    _index_stamp = _meta_stamp()
+    _result_cache.clear()
+    _remove_stale_files(store, {emb_name, ivf_name, *score_info.values()})
+
+def _write_scores(store: Path, version: str, index: dict) -> dict:
+    defect = index.get("defect_probs")
+    severity = index.get("severity_probs")
+    if len(index["paths"]) == 0:
+        defect, severity = _empty_index()["defect_probs"], _empty_index()["severity_probs"]
+    elif defect is None or severity is None or len(defect) != len(index["paths"]):
+        defect, severity = _score_embeddings(index["embeddings"])
+    np.save(store / f"defect_probs-{version}.npy", np.asarray(defect, dtype=np.float32))
+    np.save(store / f"severity_probs-{version}.npy", np.asarray(severity, dtype=np.float32))
+    return {
+        "defect_probs_file": f"defect_probs-{version}.npy",
+        "severity_probs_file": f"severity_probs-{version}.npy",
+        "prompt_fingerprint": _prompt_fingerprint(),
     }
 
-    with open(CLIP_INDEX_PATH, "wb") as f:
-        pickle.dump(_index, f)
+def _remove_stale_files(store: Path, current: set):
+    # Old matrices may still be mapped by other workers; on POSIX unlinking is
+    # safe, elsewhere they are cleaned up on a later save.
+    for pattern in ("embeddings-*.npy", "defect_probs-*.npy", "severity_probs-*.npy", "ivf-*.npz"):
+        for old in store.glob(pattern):
+            if old.name not in current:
+                try:
+                    old.unlink()
+                except OSError:
+                    pass
+
+def _refresh_scores(index: dict):
+    # The prompt sets changed since the index was written: recompute the class
+    # probabilities from the stored embeddings and swap in new column files.
+    global _index_stamp
+    print("Prompt sets changed, rescoring indexed images")
+    defect, severity = _score_embeddings(index["embeddings"])
+    index["defect_probs"], index["severity_probs"] = defect, severity
+    store = Path(CLIP_INDEX_DIR)
+    score_info = _write_scores(store, str(time.time_ns()), index)
+    conn = sqlite3.connect(_meta_path())
+    conn.executemany("INSERT OR REPLACE INTO info VALUES (?, ?)", list(score_info.items()))
+    conn.commit()
+    conn.close()
+    _index_stamp = _meta_stamp()
+    current = {index["embeddings_file"], f"ivf-{index['version']}.npz", *score_info.values()}
+    _remove_stale_files(store, current)
+
+def _read_index() -> dict | None:
+    global _index_stamp
+    meta = _meta_path()
+    if not meta.exists():
+        return None
+    stamp = _meta_stamp()
+    conn = sqlite3.connect(meta)
+    info = dict(conn.execute("SELECT key, value FROM info").fetchall())
+    rows = conn.execute(
+        "SELECT path, label, width, height, size, mtime, hash FROM images ORDER BY pos"
+    ).fetchall()
+    conn.close()
 
-    print(f"CLIP index ready: {len(valid_paths)} images")
+    emb = np.load(Path(CLIP_INDEX_DIR) / info["embeddings_file"], mmap_mode="r")
+    if emb.shape[0] != len(rows):
+        raise RuntimeError(f"CLIP index is inconsistent: {emb.shape[0]} embeddings for {len(rows)} images")
+
+    scores = {}
+    if info.get("prompt_fingerprint") == _prompt_fingerprint():
+        scores = {
+            "defect_probs": np.load(Path(CLIP_INDEX_DIR) / info["defect_probs_file"], mmap_mode="r"),
+            "severity_probs": np.load(Path(CLIP_INDEX_DIR) / info["severity_probs_file"], mmap_mode="r"),
+        }
+
+    _index_stamp = stamp
+    index = {
+        "version": info["version"],
+        "embeddings_file": info["embeddings_file"],
+        "paths": [r[0] for r in rows],
+        "embeddings": emb,
+        "labels": [r[1] for r in rows],
+        "dimensions": [(r[2], r[3]) for r in rows],
+        "files": [{"size": r[4], "mtime": r[5], "hash": r[6]} if r[6] else None for r in rows],
+        **scores,
+    }
+    index["by_path"], index["by_name"] = _build_path_maps(index["paths"])
+    if not scores and rows:
+        _refresh_scores(index)
+    return index
+
+def _migrate_pickle(wait: float = 600.0) -> dict | None:
+    # Workers starting together race for the pickle: renaming it claims it, so
+    # exactly one migrates and the others wait for its index to appear.
+    legacy = Path(CLIP_INDEX_PATH)
+    pattern = legacy.name + ".*.migrating"
+    claimed = legacy.with_name(f"{legacy.name}.{os.getpid()}.migrating")
+    try:
+        legacy.rename(claimed)
+    except FileNotFoundError:
+        deadline = time.time() + wait
+        while any(legacy.parent.glob(pattern)) and time.time() < deadline:
+            time.sleep(0.5)
+        index = _read_index()
+        if index is not None:
+            return index
+        # The worker holding the claim died mid-migration: take it over.
+        for stale in legacy.parent.glob(pattern):
+            try:
+                stale.rename(claimed)
+                break
+            except FileNotFoundError:
+                continue
+        else:
+            return None
+
+    print(f"Migrating {legacy.name} to memory-mapped index in {CLIP_INDEX_DIR}")
+    try:
+        with open(claimed, "rb") as f:
+            index = pickle.load(f)
+        if "dimensions" not in index:
+            index["dimensions"] = [(0, 0)] * len(index["paths"])
+        if "files" not in index:
+            index["files"] = [None] * len(index["paths"])
+        _save_index(index)
+    except Exception:
+        claimed.rename(legacy)
+        raise
+    claimed.rename(legacy.with_name(legacy.name + ".migrated"))
+    return _read_index()
+
+def build_clip_index():
+    global _index
+    image_paths = _scan_images()
+    if not image_paths:
+        print(f"   No images found in {IMAGES_DIR}")
+        # Still write it, so the old index is not reloaded on restart or by other workers.
+        _save_index(_empty_index())
+        _save_failed({})
+        _index = _read_index()
+        return _index
+
+    fresh = _embed_images(image_paths)
+    _save_index(fresh)
+    _save_failed(fresh["failed"])
+    _index = _read_index()
+    print(f"CLIP index ready: {len(_index['paths'])} images")
+    return _index
+
+# Images that could not be decoded or embedded, with the file state at the time,
+# so incremental syncs skip them until the file changes.
+def _failed_path() -> Path:
+    return Path(CLIP_INDEX_DIR) / "failed.json"
+
+def _load_failed() -> dict:
+    path = _failed_path()
+    if not path.exists():
+        return {}
+    try:
+        return json.loads(path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {}
+
+def _save_failed(failed: dict):
+    path = _failed_path()
+    if not failed:
+        path.unlink(missing_ok=True)
+        return
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    tmp.write_text(json.dumps(failed, indent=1), encoding="utf-8")
+    os.replace(tmp, path)
+
+def _failure_entry(path: str, error) -> dict | None:
+    try:
+        st = os.stat(path)
+        digest = _file_hash(Path(path).read_bytes())
+    except OSError:
+        return None
+    return {"size": st.st_size, "mtime": st.st_mtime, "hash": digest, "error": str(error)}
+
+def _unchanged(path: str, entry: dict | None) -> bool:
+    if not entry:
+        return False
+    try:
+        st = os.stat(path)
+    except OSError:
+        return False
+    if st.st_size == entry["size"] and st.st_mtime == entry["mtime"]:
+        return True
+    # Touched but possibly identical (e.g. re-copied survey upload): compare content.
+    if st.st_size == entry["size"] and _file_hash(Path(path).read_bytes()) == entry["hash"]:
+        entry["mtime"] = st.st_mtime
+        return True
+    return False
+
+def sync_clip_index():
+    """Bring the index in line with IMAGES_DIR, embedding only new or changed files."""
+    global _index
+    old = load_clip_index(build_missing=False)
+    if old is None:
+        return build_clip_index()
+
+    image_paths = _scan_images()
+    on_disk = set(image_paths)
+    old_pos = {p: i for i, p in enumerate(old["paths"])}
+    old_files = old.get("files") or [None] * len(old["paths"])
+    failed = {p: e for p, e in _load_failed().items() if p in on_disk}
+
+    keep = []
+    to_embed = []
+    skipped = 0
+    for p in image_paths:
+        i = old_pos.get(p)
+        if i is not None and _unchanged(p, old_files[i]):
+            keep.append(i)
+        elif _unchanged(p, failed.get(p)):
+            skipped += 1
+        else:
+            to_embed.append(p)
+    removed = sum(1 for p in old["paths"] if p not in on_disk)
+    print(f"   Sync: {len(keep)} unchanged, {len(to_embed)} new or changed, {removed} removed"
+          + (f", {skipped} skipped (failed before, file unchanged)" if skipped else ""))
+    _rebuild_progress.update({"unchanged": len(keep), "removed": removed, "skipped_failed": skipped})
+
+    fresh = _embed_images(to_embed) if to_embed else _empty_index()
+    for p in fresh["paths"]:
+        failed.pop(p, None)
+    failed.update(fresh.get("failed", {}))
+    _save_failed(failed)
+
+    # Nothing added and every old row kept: writing a new version would only
+    # invalidate search caches, IVF lists and semantic-cache entries.
+    if not fresh["paths"] and len(keep) == len(old["paths"]):
+        return old
+    parts = []
+    if keep:
+        parts.append(np.asarray(old["embeddings"])[keep])
+    if fresh["paths"]:
+        parts.append(fresh["embeddings"])
+
+    index = {
+        "paths": [old["paths"][i] for i in keep] + fresh["paths"],
+        "embeddings": np.concatenate(parts) if parts else np.array([]),
+        "labels": [old["labels"][i] for i in keep] + fresh["labels"],
+        "dimensions": [old["dimensions"][i] for i in keep] + fresh["dimensions"],
+        "files": [old_files[i] for i in keep] + fresh["files"],
+    }
+    if "defect_probs" in old:
+        index["defect_probs"] = np.concatenate([np.asarray(old["defect_probs"])[keep], fresh["defect_probs"]])
+        index["severity_probs"] = np.concatenate([np.asarray(old["severity_probs"])[keep], fresh["severity_probs"]])
+    _save_index(index)
+    _index = _read_index()
+    print(f"CLIP index synced: {len(_index['paths'])} images")
     return _index
 
-def load_clip_index():
+def load_clip_index(build_missing: bool = True):
     global _index
-    if _index is not None:
+    # Another worker may have rebuilt the index; a changed meta file means reload.
+    if _index is not None and (_index_stamp is None or _meta_stamp() == _index_stamp):
         return _index
 
-    if Path(CLIP_INDEX_PATH).exists():
-        with open(CLIP_INDEX_PATH, "rb") as f:
-            _index = pickle.load(f)
-        if "dimensions" not in _index:
-            _index["dimensions"] = [(0, 0)] * len(_index["paths"])
+    index = _read_index() or _migrate_pickle()
+    if index is not None:
+        _index = index
         print(f"Loaded CLIP index: {len(_index['paths'])} images")
         return _index
 
+    if not build_missing:
+        return None
     return build_clip_index()
 
-def search_images(query: str, k: int = None) -> list[dict]:
+def index_version() -> str | None:
+    index = load_clip_index(build_missing=False)
+    return index.get("version") if index else None
+
+def _uses_ivf(count: int) -> bool:
+    return CLIP_SEARCH_BACKEND == "ann" and count >= ANN_MIN_SIZE
+
+def _train_ivf(embeddings, path: Path) -> IVFBackend:
+    start = time.time()
+    backend = IVFBackend.train(embeddings, nlist=ANN_NLIST, nprobe=ANN_NPROBE)
+    backend.save(path)
+    print(f"Trained IVF search index: {len(backend.centroids)} lists in {time.time() - start:.1f}s")
+    return backend
+
+_backend_lock = threading.Lock()
+
+def _get_search_backend(index: dict):
+    global _backend
+    version = index.get("version")
+    current = _backend
+    if current is not None and current[0] == version and current[1].embeddings is index["embeddings"]:
+        return current[1]
+
+    with _backend_lock:
+        current = _backend
+        if current is not None and current[0] == version and current[1].embeddings is index["embeddings"]:
+            return current[1]
+        backend = ExactBackend(index["embeddings"])
+        if _uses_ivf(len(index["paths"])) and version:
+            # Normally trained by _save_index; an index written with ANN off, or
+            # migrated from the pickle, is trained here once per process.
+            ivf_path = Path(CLIP_INDEX_DIR) / f"ivf-{version}.npz"
+            if ivf_path.exists():
+                backend = IVFBackend.load(ivf_path, index["embeddings"], nprobe=ANN_NPROBE)
+            else:
+                backend = _train_ivf(index["embeddings"], ivf_path)
+        _backend = (version, backend)
+    return backend
+
+def _rel_path(path: str) -> str:
+    abs_path = Path(path)
+    try:
+        rel_path = str(abs_path.relative_to(Path(IMAGES_DIR)))
+    except ValueError:
+        rel_path = str(Path(abs_path.parent.name) / abs_path.name)
+    return rel_path.replace("\\", "/")
+
+def _build_path_maps(paths: list[str]) -> tuple[dict, dict]:
+    # Absolute and IMAGES_DIR-relative paths map to a row; bare filenames map to
+    # the first row with that name, since the agent often passes only a basename.
+    by_path = {}
+    by_name = {}
+    for i, p in enumerate(paths):
+        by_path[p] = i
+        by_path[_rel_path(p)] = i
+        by_name.setdefault(Path(p).name, i)
+    return by_path, by_name
+
+def _indexed_position(index: dict, image_path: str) -> int | None:
+    if "by_path" not in index:
+        index["by_path"], index["by_name"] = _build_path_maps(index["paths"])
+    key = image_path.strip().replace("\\", "/")
+    pos = index["by_path"].get(key)
+    if pos is None:
+        pos = index["by_path"].get(key.lstrip("/"))
+    if pos is None:
+        pos = index["by_name"].get(Path(key).name)
+    return pos
+
+def resolve_image_path(image_path: str) -> Path | None:
+    """Map a path as given by a client or the LLM to a file, without walking IMAGES_DIR."""
+    index = load_clip_index()
+    pos = _indexed_position(index, image_path)
+    if pos is not None:
+        return Path(index["paths"][pos])
+    direct = Path(IMAGES_DIR) / image_path
+    return direct if direct.is_file() else None
+
+def classify_indexed_image(image_path: str) -> dict | None:
+    """Classification of an indexed image from its stored scores, or None if it is not indexed."""
+    index = load_clip_index()
+    pos = _indexed_position(index, image_path)
+    if pos is None or "defect_probs" not in index:
+        return None
+    return _format_classification(index["defect_probs"][pos], index["severity_probs"][pos])
+
+def images_by_classification(severity: str = None, defect: str = None, limit: int = 500) -> list[dict]:
+    index = load_clip_index()
+    if len(index["paths"]) == 0 or "defect_probs" not in index:
+        return []
+
+    defect_probs = np.asarray(index["defect_probs"])
+    severity_probs = np.asarray(index["severity_probs"])
+    top_defect = defect_probs.argmax(axis=1)
+    top_severity = severity_probs.argmax(axis=1)
+    mask = np.ones(len(index["paths"]), dtype=bool)
+    if severity:
+        keys = [s["key"] for s in _SEVERITY_ENSEMBLE]
+        if severity.lower() not in keys:
+            return []
+        mask &= top_severity == keys.index(severity.lower())
+    if defect:
+        wanted = [i for i, cls in enumerate(_DEFECT_ENSEMBLE) if defect.lower() in cls["label"].lower()]
+        mask &= np.isin(top_defect, wanted)
+
+    rows = np.where(mask)[0]
+    # Most confident first
+    rows = rows[np.argsort(severity_probs[rows, top_severity[rows]])[::-1]][:limit]
+    return [{
+        "path": _rel_path(index["paths"][i]),
+        "label": index["labels"][i],
+        "top_defect": _DEFECT_ENSEMBLE[top_defect[i]]["label"],
+        "defect_prob": round(float(defect_probs[i, top_defect[i]]) * 100),
+        "severity": _SEVERITY_ENSEMBLE[top_severity[i]]["key"],
+        "severity_prob": round(float(severity_probs[i, top_severity[i]]) * 100),
+    } for i in rows]
+
+def _text_embedding(query: str) -> np.ndarray:
+    emb = _text_emb_cache.get(query)
+    if emb is None:
+        model, processor = _load_clip()
+        emb = _encode_texts(model, processor, [query])[0]
+        _text_emb_cache.put(query, emb)
+    return emb
+
+def search_cache_stats() -> dict:
+    return {"text_embeddings": _text_emb_cache.stats(), "results": _result_cache.stats()}
+
+def _facets(index: dict) -> dict:
+    # Inverted lists over the stored metadata, built once per loaded index.
+    facets = index.get("facets")
+    if facets is None:
+        top_defect = np.asarray(index["defect_probs"]).argmax(axis=1)
+        top_severity = np.asarray(index["severity_probs"]).argmax(axis=1)
+        captions: dict[str, list[int]] = {}
+        for i, label in enumerate(index["labels"]):
+            captions.setdefault(label, []).append(i)
+        facets = {
+            "defect": {c: np.flatnonzero(top_defect == c) for c in range(len(_DEFECT_ENSEMBLE))},
+            "severity": {c: np.flatnonzero(top_severity == c) for c in range(len(_SEVERITY_ENSEMBLE))},
+            "caption": {label: np.array(rows) for label, rows in captions.items()},
+            "width": np.array([d[0] for d in index["dimensions"]]),
+            "height": np.array([d[1] for d in index["dimensions"]]),
+        }
+        index["facets"] = facets
+    return facets
+
+def _filter_rows(index: dict, label: str = None, min_severity: str = None,
+                 min_width: int = 0, min_height: int = 0) -> np.ndarray | None:
+    if not (label or min_severity or min_width or min_height):
+        return None
+
+    facets = _facets(index)
+    rows = None
+    if label:
+        needle = label.lower()
+        parts = [r for c, r in facets["defect"].items() if needle in _DEFECT_ENSEMBLE[c]["label"].lower()]
+        parts += [r for caption, r in facets["caption"].items() if needle in caption.lower()]
+        rows = np.unique(np.concatenate(parts)) if parts else np.array([], dtype=np.int64)
+    if min_severity:
+        keys = [sev["key"] for sev in _SEVERITY_ENSEMBLE]
+        if min_severity.lower() not in keys:
+            raise ValueError(f"Unknown severity '{min_severity}', expected one of: {', '.join(keys)}")
+        start = keys.index(min_severity.lower())
+        sev_rows = np.concatenate([facets["severity"][c] for c in range(start, len(keys))])
+        rows = sev_rows if rows is None else np.intersect1d(rows, sev_rows)
+    if min_width or min_height:
+        dim_rows = np.flatnonzero((facets["width"] >= min_width) & (facets["height"] >= min_height))
+        rows = dim_rows if rows is None else np.intersect1d(rows, dim_rows)
+    return np.sort(rows)
+
+def search_images(query: str, k: int = None, label: str = None, min_severity: str = None,
+                  min_width: int = 0, min_height: int = 0) -> list[dict]:
     k = k or TOP_K_IMAGES
     index = load_clip_index()
 
     if len(index["paths"]) == 0:
         return []
 
-    model, processor = _load_clip()
-    inputs = processor(text=[query], return_tensors="pt", padding=True, truncation=True)
-    with torch.no_grad():
-        text_emb = model.get_text_features(**inputs).detach().numpy().flatten()
-    text_emb = text_emb / np.linalg.norm(text_emb)
-    similarities = index["embeddings"] @ text_emb
+    key = (query, k, index.get("version"), label, min_severity, min_width, min_height)
+    cached = _result_cache.get(key)
+    if cached is not None:
+        return [dict(r) for r in cached]
 
-    valid_mask = similarities >= CLIP_THRESHOLD
-    valid_indices = np.where(valid_mask)[0]
-    if len(valid_indices) == 0:
-        valid_indices = np.arange(len(similarities))
+    # Only the rows matching the filters are scored.
+    rows = _filter_rows(index, label, min_severity, min_width, min_height)
+    if rows is not None and len(rows) == 0:
+        _result_cache.put(key, [])
+        return []
 
-    sorted_indices = valid_indices[np.argsort(similarities[valid_indices])[::-1]][:k]
+    text_emb = _text_embedding(query)
+    sorted_indices, scores = _get_search_backend(index).search(text_emb, k, rows)
 
-    results = []
-    for idx in sorted_indices:
-        abs_path = Path(index["paths"][idx])
-        images_dir = Path(IMAGES_DIR)
-        try:
-            rel_path = str(abs_path.relative_to(images_dir))
-        except ValueError:
-            rel_path = str(Path(abs_path.parent.name) / abs_path.name)
+    # Same as thresholding the whole corpus first: if anything clears
+    # CLIP_THRESHOLD it is in the top k, otherwise fall back to the top k.
+    valid_mask = scores >= CLIP_THRESHOLD
+    if valid_mask.any():
+        sorted_indices, scores = sorted_indices[valid_mask], scores[valid_mask]
 
+    results = []
+    for idx, sim in zip(sorted_indices, scores):
         dims = index["dimensions"][idx] if idx < len(index["dimensions"]) else (0, 0)
         results.append({
-            "path": rel_path.replace("\\", "/"),
+            "path": _rel_path(index["paths"][idx]),
             "label": index["labels"][idx],
-            "score": _normalize_score(float(similarities[idx])),
-            "raw_score": round(float(similarities[idx]), 3),
+            "score": _normalize_score(float(sim)),
+            "raw_score": round(float(sim), 3),
             "width": dims[0],
             "height": dims[1],
         })
 
-    return results
+    _result_cache.put(key, results)
+    return [dict(r) for r in results]
 
-def rebuild_clip_index():
-    global _index, _rebuild_progress
-    _rebuild_progress = {"running": True, "indexed": 0, "total": 0, "done": False, "error": None}
-    _index = None
-    if Path(CLIP_INDEX_PATH).exists():
-        Path(CLIP_INDEX_PATH).unlink()
+def rebuild_clip_index(mode: str = "full"):
+    global _rebuild_progress
+    _rebuild_progress = {
+        "running": True, "mode": mode, "indexed": 0, "total": 0,
+        "done": False, "error": None, "images_per_sec": None,
+    }
     try:
-        result = build_clip_index()
+        if mode == "incremental":
+            result = sync_clip_index()
+        else:
+            result = build_clip_index()
         _rebuild_progress.update({"running": False, "done": True})
         return result
     except Exception as e:
         _rebuild_progress.update({"running": False, "done": True, "error": str(e)})
-        raise
\ No newline at end of file
+        raise
@@ -11,11 +11,26 @@ load_dotenv(_env_path)
 REPORTS_DIR = os.environ.get("REPORTS_DIR", str(_server_dir / "data" / "reports"))
 IMAGES_DIR = os.environ.get("IMAGES_DIR", str(_server_dir / "data" / "images"))
 CHROMA_PERSIST_DIR = os.environ.get("CHROMA_DIR", str(_server_dir / "chroma_db"))
-CLIP_INDEX_PATH = os.environ.get("CLIP_INDEX_PATH", str(_server_dir / "clip_index.pkl"))
+CLIP_INDEX_PATH = os.environ.get("CLIP_INDEX_PATH", str(_server_dir / "clip_index.pkl")) # legacy pickle, migrated on first load
+CLIP_INDEX_DIR = os.environ.get("CLIP_INDEX_DIR", str(_server_dir / "clip_store"))
+CLIP_INDEX_FP16 = os.environ.get("CLIP_INDEX_FP16", "false").lower() == "true"
+CLIP_SEARCH_BACKEND = os.environ.get("CLIP_SEARCH_BACKEND", "exact") # exact | ann
+ANN_MIN_SIZE = int(os.environ.get("ANN_MIN_SIZE", 50000)) # below this the exact scan is used anyway
+ANN_NLIST = int(os.environ.get("ANN_NLIST", 0)) # 0 = sqrt(corpus size)
+ANN_NPROBE = int(os.environ.get("ANN_NPROBE", 8))
+CLIP_QUERY_CACHE_SIZE = int(os.environ.get("CLIP_QUERY_CACHE_SIZE", 512))
 CHUNK_SIZE = int(os.environ.get("CHUNK_SIZE", 1000))
 CHUNK_OVERLAP = int(os.environ.get("CHUNK_OVERLAP", 150))
+PDF_WORKERS = int(os.environ.get("PDF_WORKERS", min(8, os.cpu_count() or 1)))
+INGEST_BATCH_SIZE = int(os.environ.get("INGEST_BATCH_SIZE", 256))
+# Uploaded reports are ingested by background jobs; INGEST_JOB_HISTORY finished
+# jobs are kept for /ingest-progress.
+INGEST_WORKERS = int(os.environ.get("INGEST_WORKERS", 1))
+INGEST_JOB_HISTORY = int(os.environ.get("INGEST_JOB_HISTORY", 200))
 EMBEDDING_MODEL = os.environ.get("EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
 CLIP_MODEL = os.environ.get("CLIP_MODEL", "openai/clip-vit-base-patch32")
+CLIP_BATCH_SIZE = int(os.environ.get("CLIP_BATCH_SIZE", 32))
+CLIP_INDEX_WORKERS = int(os.environ.get("CLIP_INDEX_WORKERS", min(8, os.cpu_count() or 1)))
 
 # LLM configuration, works with any provider
 # Set API_KEY plus optionally LLM_PROVIDER and LLM_MODEL in your .env
@@ -27,15 +42,54 @@ LLM_TEMPERATURE = float(os.environ.get("LLM_TEMPERATURE", 0.3))
 # Backwards-compat aliases (used by a few places that haven't been updated yet)
 ANTHROPIC_API_KEY = API_KEY
 CLAUDE_MODEL = LLM_MODEL
+AGENT_TOOL_WORKERS = int(os.environ.get("AGENT_TOOL_WORKERS", 4))
+RELATED_QUESTIONS_ENABLED = os.environ.get("RELATED_QUESTIONS_ENABLED", "true").lower() == "true"
 TOP_K = int(os.environ.get("TOP_K", 5))
 TOP_K_IMAGES = int(os.environ.get("TOP_K_IMAGES", 16))
 RERANK_MODEL = os.environ.get("RERANK_MODEL", "cross-encoder/ms-marco-MiniLM-L-6-v2")
 RERANK_TOP_K = int(os.environ.get("RERANK_TOP_K", 3))
+# Cross-encoder scores cached per (normalized query, chunk); uncached pairs are
+# scored in batches of RERANK_BATCH_SIZE.
+RERANK_CACHE_SIZE = int(os.environ.get("RERANK_CACHE_SIZE", 4096))
+RERANK_BATCH_SIZE = int(os.environ.get("RERANK_BATCH_SIZE", 32))
+# Recent question embeddings, shared by the semantic cache and retrieval
+QUERY_EMBED_CACHE_SIZE = int(os.environ.get("QUERY_EMBED_CACHE_SIZE", 256))
+# Hybrid retrieval: BM25 and dense results are merged with reciprocal rank
+# fusion and the best HYBRID_CANDIDATES (default 2 * k) go to the reranker.
+HYBRID_SEARCH = os.environ.get("HYBRID_SEARCH", "true").lower() == "true"
+HYBRID_CANDIDATES = int(os.environ.get("HYBRID_CANDIDATES", 0))
+RRF_K = int(os.environ.get("RRF_K", 60))
 PROMPT_FILE = os.environ.get("PROMPT_FILE", str(_server_dir / "prompt.txt"))
 CACHE_ENABLED = os.environ.get("CACHE_ENABLED", "true").lower() == "true"
 CACHE_MAX_SIZE = int(os.environ.get("CACHE_MAX_SIZE", 200))
 CACHE_SIMILARITY_THRESHOLD = float(os.environ.get("CACHE_SIMILARITY_THRESHOLD", 0.97))
 LOG_DB_PATH = os.environ.get("LOG_DB_PATH", str(_server_dir / "logs.db"))
+# Optional persistent semantic cache: entries are written through to SQLite on
+# put and reloaded at startup; hit counts and evictions are flushed by a
+# background compaction every CACHE_COMPACT_INTERVAL seconds.
+CACHE_PERSIST = os.environ.get("CACHE_PERSIST", "false").lower() == "true"
+CACHE_PERSIST_PATH = os.environ.get("CACHE_PERSIST_PATH", str(Path(LOG_DB_PATH).parent / "semantic_cache.db"))
+CACHE_COMPACT_INTERVAL = int(os.environ.get("CACHE_COMPACT_INTERVAL", 300))
+# Seconds before a cached answer expires regardless of corpus changes; 0 disables.
+CACHE_TTL = int(os.environ.get("CACHE_TTL", 0))
+CLASSIFY_CACHE_PATH = os.environ.get("CLASSIFY_CACHE_PATH", str(Path(LOG_DB_PATH).parent / "classify_cache.db"))
+CLASSIFY_CACHE_MEMORY_SIZE = int(os.environ.get("CLASSIFY_CACHE_MEMORY_SIZE", 1024))
+# Per-model load policy for startup, e.g. "clip=eager,reranker=lazy"; "*" sets the default
+MODEL_LOAD_POLICY = {
+    name.strip(): policy.strip()
+    for name, _, policy in (
+        item.partition("=") for item in os.environ.get("MODEL_LOAD_POLICY", "*=eager").split(",") if "=" in item
+    )
+}
+STARTUP_WORKERS = int(os.environ.get("STARTUP_WORKERS", 3))
+# Seconds a model may sit unused before it is unloaded (reloaded on next use); 0 keeps models loaded.
+MODEL_IDLE_UNLOAD = int(os.environ.get("MODEL_IDLE_UNLOAD", 0))
+# "torch" runs the PyTorch models; "onnx" exports them once to ONNX_DIR and serves
+# them with onnxruntime (int8 dynamically quantized unless ONNX_QUANTIZE=false).
+INFERENCE_BACKEND = os.environ.get("INFERENCE_BACKEND", "torch").lower()
+ONNX_DIR = os.environ.get("ONNX_DIR", str(Path(__file__).parent / "onnx_models"))
+ONNX_QUANTIZE = os.environ.get("ONNX_QUANTIZE", "true").lower() == "true"
+ONNX_THREADS = int(os.environ.get("ONNX_THREADS", 0))
 HOST = os.environ.get("HOST", "0.0.0.0")
 PORT = int(os.environ.get("PORT", 8000))
 STATIC_IMAGES_DIR = os.environ.get("STATIC_IMAGES_DIR", IMAGES_DIR)
@@ -0,0 +1,56 @@
+import argparse
+import sys
+import time
+from pathlib import Path
+import numpy as np
+sys.path.insert(0, str(Path(__file__).parent))
+from clip_index import load_clip_index, _load_clip, _encode_texts, CLIP_CAPTIONS, _DEFECT_ENSEMBLE
+from search_backend import IVFBackend, recall_report
+from config import ANN_NLIST
+
+def build_queries(index: dict, n_image_queries: int, use_text: bool) -> np.ndarray:
+    queries = []
+    if use_text:
+        model, processor = _load_clip()
+        prompts = CLIP_CAPTIONS + [p for cls in _DEFECT_ENSEMBLE for p in cls["prompts"]]
+        queries.append(_encode_texts(model, processor, prompts))
+
+    # Perturbed image embeddings stand in for "more like this" queries.
+    rng = np.random.default_rng(0)
+    n = len(index["paths"])
+    rows = np.sort(rng.choice(n, size=min(n, n_image_queries), replace=False))
+    imgs = np.asarray(index["embeddings"][rows], dtype=np.float32)
+    imgs = imgs + rng.normal(scale=0.05, size=imgs.shape).astype(np.float32)
+    queries.append(imgs / np.linalg.norm(imgs, axis=1, keepdims=True))
+    return np.concatenate(queries)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare exact and IVF image search on the local CLIP index")
+    parser.add_argument("--k", type=int, default=16, help="Results per query")
+    parser.add_argument("--queries", type=int, default=200, help="Number of image-embedding queries")
+    parser.add_argument("--nlist", type=int, default=ANN_NLIST, help="IVF lists (0 = sqrt(corpus size))")
+    parser.add_argument("--no-text", action="store_true", help="Skip CLIP text prompt queries")
+    args = parser.parse_args()
+
+    index = load_clip_index(build_missing=False)
+    if index is None or len(index["paths"]) == 0:
+        print("No CLIP index found, build one first.")
+        sys.exit(1)
+
+    embeddings = index["embeddings"]
+    print(f"Index: {len(index['paths'])} images, dim {embeddings.shape[1]}, dtype {embeddings.dtype}")
+    queries = build_queries(index, args.queries, not args.no_text)
+
+    start = time.time()
+    ivf = IVFBackend.train(embeddings, nlist=args.nlist)
+    print(f"Trained IVF with {len(ivf.centroids)} lists in {time.time() - start:.1f}s")
+    print(f"Running {len(queries)} queries at k={args.k}\n")
+
+    rows = recall_report(embeddings, queries, ivf, k=args.k)
+    exact_ms = rows[0]["avg_ms"]
+    print(f"{'Backend':<8} {'nprobe':>7} {'Recall':>8} {'Avg ms':>9} {'Speedup':>8}")
+    print("-" * 44)
+    for r in rows:
+        nprobe = "-" if r["nprobe"] is None else str(r["nprobe"])
+        speedup = exact_ms / r["avg_ms"] if r["avg_ms"] > 0 else 0.0
+        print(f"{r['backend']:<8} {nprobe:>7} {r['recall']:>8.3f} {r['avg_ms']:>9.3f} {speedup:>7.1f}x")
@@ -0,0 +1,57 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from config import INGEST_WORKERS, INGEST_JOB_HISTORY
+from vectorstore import ingest_pdf
+
+_jobs: OrderedDict = OrderedDict()
+_lock = threading.Lock()
+_executor = ThreadPoolExecutor(max_workers=INGEST_WORKERS, thread_name_prefix="ingest")
+
+def _forget_finished():
+    finished = [job_id for job_id, job in _jobs.items() if job["status"] in ("done", "error")]
+    for job_id in finished[:max(0, len(finished) - INGEST_JOB_HISTORY)]:
+        del _jobs[job_id]
+
+def _run(store, pdf_bytes: bytes, job: dict):
+    job.update({"status": "running", "started": time.time()})
+    try:
+        job["chunks_added"] = ingest_pdf(store, pdf_bytes, job["filename"], progress=job)
+        job["status"] = "done"
+    except Exception as e:
+        print(f"   Ingest of {job['filename']} failed: {e}")
+        job.update({"status": "error", "error": str(e)})
+    finally:
+        job["finished"] = time.time()
+
+def submit_report(store, pdf_bytes: bytes, filename: str) -> dict:
+    """Queue a report for ingestion and return its job record straight away."""
+    job = {
+        "job_id": uuid.uuid4().hex[:12],
+        "filename": filename,
+        "status": "queued",
+        "pages_total": 0,
+        "pages_parsed": 0,
+        "chunks_total": 0,
+        "chunks_embedded": 0,
+        "chunks_added": None,
+        "error": None,
+        "submitted": time.time(),
+        "started": None,
+        "finished": None,
+    }
+    with _lock:
+        _jobs[job["job_id"]] = job
+        _forget_finished()
+    _executor.submit(_run, store, pdf_bytes, job)
+    return dict(job)
+
+def get_job(job_id: str) -> dict | None:
+    job = _jobs.get(job_id)
+    return dict(job) if job else None
+
+def list_jobs() -> list[dict]:
+    with _lock:
+        return [dict(job) for job in _jobs.values()]
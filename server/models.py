@@ -0,0 +1,142 @@
+import ctypes
+import gc
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from config import MODEL_IDLE_UNLOAD
+
+# Every heavy model is loaded through here, so each exists once per process no
+# matter how many modules use it. Callers should not keep their own long-lived
+# references: with MODEL_IDLE_UNLOAD set, models unused for that many seconds
+# are dropped and reloaded on the next get_model.
+
+class _Slot:
+    def __init__(self, name: str, loader, unloadable: bool):
+        self.name = name
+        self.loader = loader
+        self.unloadable = unloadable
+        # (loaded, instance), replaced as a whole so readers never see half an update.
+        self.state = (False, None)
+        self.lock = threading.Lock()
+        self.last_used = 0.0
+        self.load_seconds = None
+        self.loads = 0
+        self.nbytes = None
+        self.in_use = 0
+
+_slots: dict[str, _Slot] = {}
+_registry_lock = threading.Lock()
+_reaper = None
+
+def register_model(name: str, loader, unloadable: bool = True):
+    with _registry_lock:
+        if name not in _slots:
+            _slots[name] = _Slot(name, loader, unloadable)
+
+def get_model(name: str):
+    slot = _slots[name]
+    slot.last_used = time.time()
+    # One read of the pair: the reaper may unload between two separate reads.
+    loaded, instance = slot.state
+    if loaded:
+        return instance
+    with slot.lock:
+        loaded, instance = slot.state
+        if not loaded:
+            start = time.time()
+            instance = slot.loader()
+            slot.load_seconds = round(time.time() - start, 2)
+            slot.loads += 1
+            slot.nbytes = model_nbytes(instance)
+            slot.state = (True, instance)
+    return instance
+
+def is_loaded(name: str) -> bool:
+    slot = _slots.get(name)
+    return bool(slot and slot.state[0])
+
+@contextmanager
+def using(name: str):
+    """Keep a model from being unloaded while a long job holds it."""
+    slot = _slots[name]
+    slot.in_use += 1
+    try:
+        yield get_model(name)
+    finally:
+        slot.in_use -= 1
+        slot.last_used = time.time()
+
+def _release_memory():
+    gc.collect()
+    if sys.platform.startswith("linux"):
+        # Hand freed arenas back to the OS so RSS actually drops.
+        try:
+            ctypes.CDLL("libc.so.6").malloc_trim(0)
+        except Exception:
+            pass
+
+def unload_model(name: str) -> bool:
+    slot = _slots[name]
+    with slot.lock:
+        if not slot.state[0] or slot.in_use:
+            return False
+        slot.state = (False, None)
+    _release_memory()
+    print(f"   Unloaded model: {name}")
+    return True
+
+def unload_idle(max_idle: float) -> list[str]:
+    now = time.time()
+    idle = [
+        s.name for s in list(_slots.values())
+        if s.state[0] and s.unloadable and not s.in_use and now - s.last_used > max_idle
+    ]
+    return [name for name in idle if unload_model(name)]
+
+def _reap_loop(max_idle: float):
+    while True:
+        time.sleep(max(5.0, min(60.0, max_idle / 2)))
+        unload_idle(max_idle)
+
+def start_idle_unloader(max_idle: float = MODEL_IDLE_UNLOAD):
+    global _reaper
+    if max_idle > 0 and _reaper is None:
+        _reaper = threading.Thread(target=_reap_loop, args=(max_idle,), name="model-unload", daemon=True)
+        _reaper.start()
+
+def model_nbytes(obj, _seen: set = None, _depth: int = 0) -> int:
+    """Bytes held in weights: torch parameters and buffers, or ONNX graph files."""
+    _seen = set() if _seen is None else _seen
+    if obj is None or id(obj) in _seen or _depth > 3:
+        return 0
+    _seen.add(id(obj))
+    torch = sys.modules.get("torch")
+    if torch is not None and isinstance(obj, torch.nn.Module):
+        tensors = {t.data_ptr(): t.numel() * t.element_size() for t in list(obj.parameters()) + list(obj.buffers())}
+        return sum(tensors.values())
+    if isinstance(obj, (tuple, list)):
+        return sum(model_nbytes(o, _seen, _depth + 1) for o in obj)
+    paths = getattr(obj, "model_paths", None)
+    if paths:
+        return sum(Path(p).stat().st_size for p in paths if Path(p).exists())
+    attrs = getattr(obj, "__dict__", None)
+    if not attrs:
+        return 0
+    return sum(model_nbytes(v, _seen, _depth + 1) for v in attrs.values() if not isinstance(v, (str, bytes, int, float)))
+
+def model_report() -> list[dict]:
+    now = time.time()
+    return [
+        {
+            "name": s.name,
+            "loaded": s.state[0],
+            "mb": round(s.nbytes / 2**20, 1) if s.state[0] and s.nbytes is not None else None,
+            "load_seconds": s.load_seconds,
+            "loads": s.loads,
+            "idle_seconds": round(now - s.last_used) if s.state[0] else None,
+            "in_use": s.in_use,
+        }
+        for s in _slots.values()
+    ]
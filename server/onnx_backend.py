@@ -0,0 +1,381 @@
+import argparse
+import json
+import re
+import sys
+import threading
+from pathlib import Path
+import numpy as np
+from langchain_core.embeddings import Embeddings
+sys.path.insert(0, str(Path(__file__).parent))
+from config import (
+    ONNX_DIR,
+    ONNX_QUANTIZE,
+    ONNX_THREADS,
+    CLIP_MODEL,
+    EMBEDDING_MODEL,
+    RERANK_MODEL,
+)
+
+# Exported graphs live in ONNX_DIR/<model name>/. Export and quantization run
+# once, the first time a model is requested with INFERENCE_BACKEND=onnx, and
+# need the original weights. Serving runs the forward passes in onnxruntime,
+# but still needs transformers for the tokenizers and CLIPProcessor, and torch
+# for the tensors clip_index preprocesses images and text into.
+_OPSET = 17
+_export_lock = threading.Lock()
+
+def _model_dir(model_name: str) -> Path:
+    return Path(ONNX_DIR) / re.sub(r"[^A-Za-z0-9_.-]+", "__", model_name)
+
+def _session(path: Path):
+    import onnxruntime as ort
+    opts = ort.SessionOptions()
+    if ONNX_THREADS > 0:
+        opts.intra_op_num_threads = ONNX_THREADS
+    opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    return ort.InferenceSession(str(path), sess_options=opts, providers=["CPUExecutionProvider"])
+
+def _graph_path(model_dir: Path, name: str, quantize: bool) -> Path:
+    return model_dir / (f"{name}.int8.onnx" if quantize else f"{name}.onnx")
+
+def _quantize(src: Path, dst: Path):
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    quantize_dynamic(str(src), str(dst), weight_type=QuantType.QInt8)
+
+def _export(module, args: tuple, path: Path, input_names: list[str], output_names: list[str], dynamic_axes: dict):
+    import torch
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + ".tmp")
+    with torch.no_grad():
+        torch.onnx.export(
+            module.eval(), args, str(tmp),
+            input_names=input_names, output_names=output_names,
+            dynamic_axes=dynamic_axes, opset_version=_OPSET, dynamo=False,
+        )
+    tmp.replace(path)
+
+def _ensure_graph(model_dir: Path, name: str, quantize: bool, export_fn) -> Path:
+    fp32 = _graph_path(model_dir, name, False)
+    target = _graph_path(model_dir, name, quantize)
+    with _export_lock:
+        if not fp32.exists():
+            print(f"   Exporting {model_dir.name}/{name} to ONNX")
+            export_fn(fp32)
+        if quantize and not target.exists():
+            print(f"   Quantizing {model_dir.name}/{name} to int8")
+            _quantize(fp32, target)
+    return target
+
+def _as_numpy(x) -> np.ndarray:
+    return x.detach().cpu().numpy() if hasattr(x, "detach") else np.asarray(x)
+
+def _pooled(out):
+    # transformers>=5 returns a model output for get_*_features
+    return out if not hasattr(out, "pooler_output") else out.pooler_output
+
+class OnnxClip:
+    """Stands in for CLIPModel in clip_index: get_*_features return numpy arrays."""
+
+    def __init__(self, model_name: str = CLIP_MODEL, quantize: bool = ONNX_QUANTIZE):
+        model_dir = _model_dir(model_name)
+        meta_path = model_dir / "clip_meta.json"
+        text_path = _ensure_graph(model_dir, "text", quantize, lambda p: self._export_text(model_name, p))
+        vision_path = _ensure_graph(model_dir, "vision", quantize, lambda p: self._export_vision(model_name, p))
+        if not meta_path.exists():
+            self._write_meta(model_name, meta_path)
+        self.logit_scale = json.loads(meta_path.read_text())["logit_scale"]
+        self._text = _session(text_path)
+        self._vision = _session(vision_path)
+        self.model_paths = [text_path, vision_path]
+
+    @staticmethod
+    def _torch_model(model_name: str):
+        from transformers import CLIPModel
+        return CLIPModel.from_pretrained(model_name).eval()
+
+    @classmethod
+    def _export_text(cls, model_name: str, path: Path):
+        import torch
+        model = cls._torch_model(model_name)
+
+        class TextEncoder(torch.nn.Module):
+            def __init__(self):
+                super().__init__()
+                self.model = model
+
+            def forward(self, input_ids, attention_mask):
+                return _pooled(self.model.get_text_features(input_ids=input_ids, attention_mask=attention_mask))
+
+        ids = torch.ones((2, 8), dtype=torch.long)
+        _export(TextEncoder(), (ids, torch.ones_like(ids)), path,
+                ["input_ids", "attention_mask"], ["text_embeds"],
+                {"input_ids": {0: "batch", 1: "seq"}, "attention_mask": {0: "batch", 1: "seq"}, "text_embeds": {0: "batch"}})
+
+    @classmethod
+    def _export_vision(cls, model_name: str, path: Path):
+        import torch
+        model = cls._torch_model(model_name)
+        size = model.config.vision_config.image_size
+
+        class VisionEncoder(torch.nn.Module):
+            def __init__(self):
+                super().__init__()
+                self.model = model
+
+            def forward(self, pixel_values):
+                return _pooled(self.model.get_image_features(pixel_values=pixel_values))
+
+        _export(VisionEncoder(), (torch.zeros((2, 3, size, size)),), path,
+                ["pixel_values"], ["image_embeds"],
+                {"pixel_values": {0: "batch"}, "image_embeds": {0: "batch"}})
+
+    @classmethod
+    def _write_meta(cls, model_name: str, path: Path):
+        model = cls._torch_model(model_name)
+        path.write_text(json.dumps({"logit_scale": float(model.logit_scale)}))
+
+    def get_text_features(self, input_ids, attention_mask=None, **_) -> np.ndarray:
+        ids = _as_numpy(input_ids).astype(np.int64)
+        mask = np.ones_like(ids) if attention_mask is None else _as_numpy(attention_mask).astype(np.int64)
+        return self._text.run(None, {"input_ids": ids, "attention_mask": mask})[0]
+
+    def get_image_features(self, pixel_values, **_) -> np.ndarray:
+        return self._vision.run(None, {"pixel_values": _as_numpy(pixel_values).astype(np.float32)})[0]
+
+def _encoder_inputs(session, encoded: dict) -> dict:
+    names = {i.name for i in session.get_inputs()}
+    return {k: np.asarray(v, dtype=np.int64) for k, v in encoded.items() if k in names}
+
+def _export_hf_encoder(model, tokenizer, path: Path, output_name: str):
+    import torch
+    sample = tokenizer(["warm up", "a second sample"], padding=True, return_tensors="pt")
+    names = [n for n in ("input_ids", "attention_mask", "token_type_ids") if n in sample]
+
+    class Encoder(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.model = model
+
+        def forward(self, *args):
+            out = self.model(**dict(zip(names, args)))
+            return out[0]
+
+    axes = {n: {0: "batch", 1: "seq"} for n in names}
+    axes[output_name] = {0: "batch", 1: "seq"} if output_name == "last_hidden_state" else {0: "batch"}
+    _export(Encoder(), tuple(sample[n] for n in names), path, names, [output_name], axes)
+
+class OnnxEmbeddings(Embeddings):
+    """LangChain-compatible replacement for HuggingFaceEmbeddings (normalized sentence embeddings)."""
+
+    def __init__(self, model_name: str = EMBEDDING_MODEL, quantize: bool = ONNX_QUANTIZE, batch_size: int = 32):
+        from transformers import AutoTokenizer
+        model_dir = _model_dir(model_name)
+        meta_path = model_dir / "embed_meta.json"
+        path = _ensure_graph(model_dir, "encoder", quantize, lambda p: self._export(model_name, p, meta_path))
+        meta = json.loads(meta_path.read_text())
+        self.max_length = meta["max_length"]
+        self.pooling = meta["pooling"]
+        self.batch_size = batch_size
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self._session = _session(path)
+        self.model_paths = [path]
+
+    @staticmethod
+    def _export(model_name: str, path: Path, meta_path: Path):
+        from sentence_transformers import SentenceTransformer
+        st = SentenceTransformer(model_name, device="cpu")
+        pooling = "mean"
+        for module in st:
+            mode = getattr(module, "pooling_mode_cls_token", None)
+            if mode:
+                pooling = "cls"
+        _export_hf_encoder(st[0].auto_model, st.tokenizer, path, "last_hidden_state")
+        meta_path.write_text(json.dumps({"max_length": st.max_seq_length, "pooling": pooling}))
+
+    def _encode(self, texts: list[str]) -> list[list[float]]:
+        out = []
+        for start in range(0, len(texts), self.batch_size):
+            batch = texts[start:start + self.batch_size]
+            enc = self.tokenizer(batch, padding=True, truncation=True, max_length=self.max_length, return_tensors="np")
+            hidden = self._session.run(None, _encoder_inputs(self._session, enc))[0]
+            if self.pooling == "cls":
+                vecs = hidden[:, 0]
+            else:
+                mask = enc["attention_mask"][..., None].astype(np.float32)
+                vecs = (hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+            vecs = vecs / np.maximum(np.linalg.norm(vecs, axis=1, keepdims=True), 1e-12)
+            out.extend(vecs.tolist())
+        return out
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self._encode(list(texts))
+
+    def embed_query(self, text: str) -> list[float]:
+        return self._encode([text])[0]
+
+class OnnxCrossEncoder:
+    """Replacement for sentence_transformers.CrossEncoder.predict.
+
+    Returns raw logits; the activation CrossEncoder may apply is monotonic, so
+    rankings are unchanged.
+    """
+
+    def __init__(self, model_name: str = RERANK_MODEL, quantize: bool = ONNX_QUANTIZE, max_length: int = 512):
+        from transformers import AutoTokenizer
+        model_dir = _model_dir(model_name)
+        path = _ensure_graph(model_dir, "cross_encoder", quantize, lambda p: self._export(model_name, p))
+        self.max_length = max_length
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self._session = _session(path)
+        self.model_paths = [path]
+
+    @staticmethod
+    def _export(model_name: str, path: Path):
+        from transformers import AutoModelForSequenceClassification, AutoTokenizer
+        model = AutoModelForSequenceClassification.from_pretrained(model_name)
+        _export_hf_encoder(model, AutoTokenizer.from_pretrained(model_name), path, "logits")
+
+    def predict(self, pairs, batch_size: int = 32, **_) -> np.ndarray:
+        pairs = list(pairs)
+        scores = []
+        for start in range(0, len(pairs), batch_size):
+            batch = pairs[start:start + batch_size]
+            enc = self.tokenizer(
+                [a for a, _ in batch], [b for _, b in batch],
+                padding=True, truncation=True, max_length=self.max_length, return_tensors="np",
+            )
+            logits = self._session.run(None, _encoder_inputs(self._session, enc))[0]
+            scores.append(logits[:, 0] if logits.shape[1] == 1 else logits)
+        return np.concatenate(scores) if scores else np.array([])
+
+def _rank_overlap(a: np.ndarray, b: np.ndarray, k: int) -> float:
+    return len(set(np.argsort(a)[::-1][:k]) & set(np.argsort(b)[::-1][:k])) / k
+
+def _spearman(a: np.ndarray, b: np.ndarray) -> float:
+    ra = np.argsort(np.argsort(a)).astype(np.float64)
+    rb = np.argsort(np.argsort(b)).astype(np.float64)
+    if ra.std() == 0 or rb.std() == 0:
+        return 1.0
+    return float(np.corrcoef(ra, rb)[0, 1])
+
+def _sample_images(n: int) -> list:
+    import random
+    from PIL import Image
+    from clip_index import _scan_images
+    paths = sorted(_scan_images())
+    images = []
+    for path in random.Random(0).sample(paths, min(n, len(paths))):
+        try:
+            images.append(Image.open(path).convert("RGB"))
+        except Exception as e:
+            print(f"Skipping {path}: {e}")
+    return images
+
+def parity_check(quantize: bool = ONNX_QUANTIZE, tolerance: float = 0.9, images: int = 32) -> list[dict]:
+    """Compare ONNX rankings with the PyTorch path on fixed domain queries and
+    a sample of IMAGES_DIR ranked against the prompt bank."""
+    import torch
+    from transformers import CLIPModel, CLIPProcessor
+    from clip_index import CLIP_CAPTIONS, _DEFECT_ENSEMBLE, _SEVERITY_ENSEMBLE
+    from eval import load_eval_set, EVAL_SET_PATH
+
+    queries = [item["question"] for item in load_eval_set(EVAL_SET_PATH)]
+    passages = [p for cls in _DEFECT_ENSEMBLE for p in cls["prompts"]] + CLIP_CAPTIONS
+    k = 5
+    results = []
+
+    # CLIP: rank the caption/prompt texts for each query by text-text similarity.
+    processor = CLIPProcessor.from_pretrained(CLIP_MODEL)
+    torch_clip = CLIPModel.from_pretrained(CLIP_MODEL).eval()
+    onnx_clip = OnnxClip(quantize=quantize)
+
+    def clip_embed(model, texts):
+        inputs = processor(text=texts, return_tensors="pt", padding=True, truncation=True)
+        with torch.no_grad():
+            feats = _as_numpy(_pooled(model.get_text_features(**inputs)))
+        return feats / np.linalg.norm(feats, axis=1, keepdims=True)
+
+    results.append(_compare("clip", clip_embed(torch_clip, queries), clip_embed(torch_clip, passages),
+                            clip_embed(onnx_clip, queries), clip_embed(onnx_clip, passages), k, tolerance))
+
+    # CLIP vision: the graph that builds the index and scores defects, and the
+    # one most affected by int8 quantization. Rank the whole prompt bank per image.
+    def clip_embed_images(model, imgs):
+        inputs = processor(images=imgs, return_tensors="pt")
+        with torch.no_grad():
+            feats = _as_numpy(_pooled(model.get_image_features(**inputs)))
+        return feats / np.linalg.norm(feats, axis=1, keepdims=True)
+
+    sample = _sample_images(images)
+    if sample:
+        bank = [p for cls in _DEFECT_ENSEMBLE + _SEVERITY_ENSEMBLE for p in cls["prompts"]] + CLIP_CAPTIONS
+        results.append(_compare("clip_vision", clip_embed_images(torch_clip, sample), clip_embed(torch_clip, bank),
+                                clip_embed_images(onnx_clip, sample), clip_embed(onnx_clip, bank), k, tolerance))
+    else:
+        print("No images in IMAGES_DIR, vision graph not checked")
+
+    from langchain_huggingface import HuggingFaceEmbeddings
+    torch_emb = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL, encode_kwargs={"normalize_embeddings": True})
+    onnx_emb = OnnxEmbeddings(quantize=quantize)
+    results.append(_compare(
+        "embedding",
+        np.array(torch_emb.embed_documents(queries)), np.array(torch_emb.embed_documents(passages)),
+        np.array(onnx_emb.embed_documents(queries)), np.array(onnx_emb.embed_documents(passages)),
+        k, tolerance,
+    ))
+
+    from sentence_transformers import CrossEncoder
+    torch_ce = CrossEncoder(RERANK_MODEL)
+    onnx_ce = OnnxCrossEncoder(quantize=quantize)
+    overlaps, rhos = [], []
+    for q in queries:
+        pairs = [(q, p) for p in passages]
+        a = np.asarray(torch_ce.predict(pairs)).reshape(len(pairs), -1)[:, 0]
+        b = onnx_ce.predict(pairs).reshape(len(pairs), -1)[:, 0]
+        overlaps.append(_rank_overlap(a, b, k))
+        rhos.append(_spearman(a, b))
+    results.append(_summary("reranker", overlaps, rhos, tolerance))
+    return results
+
+def _compare(name, tq, tp, oq, op, k, tolerance) -> dict:
+    overlaps, rhos = [], []
+    for a, b in zip(tq @ tp.T, oq @ op.T):
+        overlaps.append(_rank_overlap(a, b, k))
+        rhos.append(_spearman(a, b))
+    result = _summary(name, overlaps, rhos, tolerance)
+    result["min_cosine"] = round(float(np.min(np.sum(tq * oq, axis=1))), 4)
+    return result
+
+def _summary(name, overlaps, rhos, tolerance) -> dict:
+    overlap = float(np.mean(overlaps))
+    rho = float(np.mean(rhos))
+    return {
+        "model": name,
+        "top5_overlap": round(overlap, 3),
+        "spearman": round(rho, 3),
+        "ok": overlap >= tolerance and rho >= tolerance,
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export models to ONNX and check ranking parity with PyTorch")
+    parser.add_argument("--export", action="store_true", help="Export (and quantize) all models, then exit")
+    parser.add_argument("--fp32", action="store_true", help="Use the unquantized graphs")
+    parser.add_argument("--tolerance", type=float, default=0.9, help="Minimum top-5 overlap and Spearman rho")
+    parser.add_argument("--images", type=int, default=32, help="Images sampled from IMAGES_DIR for the vision check")
+    args = parser.parse_args()
+    quantize = ONNX_QUANTIZE and not args.fp32
+
+    if args.export:
+        OnnxClip(quantize=quantize)
+        OnnxEmbeddings(quantize=quantize)
+        OnnxCrossEncoder(quantize=quantize)
+        print(f"ONNX models ready in {ONNX_DIR}")
+        sys.exit(0)
+
+    rows = parity_check(quantize=quantize, tolerance=args.tolerance, images=args.images)
+    print(f"\n{'Model':<12} {'Top-5':>7} {'Spearman':>9} {'Min cos':>8}  Result")
+    print("-" * 48)
+    for r in rows:
+        cos = f"{r['min_cosine']:.4f}" if "min_cosine" in r else "-"
+        print(f"{r['model']:<12} {r['top5_overlap']:>7.3f} {r['spearman']:>9.3f} {cos:>8}  {'ok' if r['ok'] else 'FAIL'}")
+    sys.exit(0 if all(r["ok"] for r in rows) else 1)
@@ -1,7 +1,10 @@
+import hashlib
+import re
+from collections import defaultdict
 from pathlib import Path
 from langchain_chroma import Chroma
+from langchain_core.documents import Document
 from langchain_core.messages import SystemMessage, HumanMessage, AIMessage
-from sentence_transformers import CrossEncoder
 from config import (
     API_KEY,
     LLM_PROVIDER,
@@ -12,16 +15,58 @@ from config import (
     RERANK_MODEL,
     RERANK_TOP_K,
     PROMPT_FILE,
+    INFERENCE_BACKEND,
+    RERANK_CACHE_SIZE,
+    RERANK_BATCH_SIZE,
+    HYBRID_SEARCH,
+    HYBRID_CANDIDATES,
+    RRF_K,
 )
+from lru import LRUCache
+from bm25 import lexical_search
+from query_embeddings import embed_query
+from models import register_model, get_model
 
-_reranker = None
+_rerank_cache = LRUCache(RERANK_CACHE_SIZE)
+
+def _load_reranker():
+    print(f"loading {RERANK_MODEL} ({INFERENCE_BACKEND})")
+    if INFERENCE_BACKEND == "onnx":
+        from onnx_backend import OnnxCrossEncoder
+        return OnnxCrossEncoder(RERANK_MODEL)
+    from sentence_transformers import CrossEncoder
+    return CrossEncoder(RERANK_MODEL)
+
+register_model("reranker", _load_reranker)
 
 def _get_reranker():
-    global _reranker
-    if _reranker is None:
-        print(f"loading {RERANK_MODEL}")
-        _reranker = CrossEncoder(RERANK_MODEL)
-    return _reranker
+    return get_model("reranker")
+
+def warm_up_reranker():
+    _get_reranker().predict([("warm up", "warm up")])
+
+def _normalize_query(query: str) -> str:
+    return re.sub(r"\s+", " ", query).strip().lower()
+
+def _chunk_id(doc) -> str:
+    # Chroma returns the stored id; hash the text for stores that do not.
+    return getattr(doc, "id", None) or hashlib.sha1(doc.page_content.encode("utf-8")).hexdigest()
+
+def rerank_scores(query: str, docs: list[dict]) -> list[float]:
+    """Cross-encoder scores for docs, scoring only pairs not already cached."""
+    q = _normalize_query(query)
+    scores = [_rerank_cache.get((q, d["chunk_id"])) for d in docs]
+    missing = [i for i, s in enumerate(scores) if s is None]
+    if missing:
+        pairs = [(query, docs[i]["content"]) for i in missing]
+        fresh = _get_reranker().predict(pairs, batch_size=RERANK_BATCH_SIZE)
+        for i, s in zip(missing, fresh):
+            scores[i] = float(s)
+            _rerank_cache.put((q, docs[i]["chunk_id"]), scores[i])
+    return scores
+
+def rerank_cache_stats() -> dict:
+    return _rerank_cache.stats()
 
 def load_system_prompt() -> str:
     path = Path(PROMPT_FILE)
@@ -72,25 +117,48 @@ def build_llm(streaming: bool = True, max_tokens: int = 1024):
             "Supported values: anthropic, openai, google"
         )
 
+def _doc_entry(doc, score: float | None) -> dict:
+    return {
+        "content": doc.page_content[:500],
+        "full_content": doc.page_content,
+        "chunk_id": _chunk_id(doc),
+        "source_label": doc.metadata.get("source_label", "?"),
+        "report": doc.metadata.get("report", "?"),
+        "score": round(float(score), 3) if score is not None else None,
+    }
+
+def _fuse_lexical(store: Chroma, query: str, docs: list[dict], fetch_k: int, n: int) -> list[dict]:
+    """Reciprocal rank fusion of dense results with BM25 hits; keeps the best n."""
+    lexical = lexical_search(query, fetch_k)
+    fused = defaultdict(float)
+    for rank, d in enumerate(docs):
+        fused[d["chunk_id"]] += 1.0 / (RRF_K + rank + 1)
+    for rank, (chunk_id, _) in enumerate(lexical):
+        fused[chunk_id] += 1.0 / (RRF_K + rank + 1)
+    best = sorted(fused, key=fused.get, reverse=True)[:n]
+
+    by_id = {d["chunk_id"]: d for d in docs}
+    missing = [i for i in best if i not in by_id]
+    if missing:
+        # Lexical-only hits have no dense distance.
+        found = store.get(ids=missing, include=["documents", "metadatas"])
+        for chunk_id, text, meta in zip(found["ids"], found["documents"], found["metadatas"]):
+            by_id[chunk_id] = _doc_entry(Document(page_content=text, metadata=meta or {}, id=chunk_id), None)
+    return [by_id[i] for i in best if i in by_id]
+
 def retrieve(store: Chroma, query: str, k: int = None, rerank: bool = True):
     k = k or TOP_K
     fetch_k = k * 3 if rerank else k
-    results = store.similarity_search_with_score(query, k=fetch_k)
-    docs = []
-    for doc, score in results:
-        docs.append({
-            "content": doc.page_content[:500],
-            "full_content": doc.page_content,
-            "source_label": doc.metadata.get("source_label", "?"),
-            "report": doc.metadata.get("report", "?"),
-            "score": round(float(score), 3),
-        })
+    # Same distances as similarity_search_with_score, but the question vector
+    # is shared with the semantic cache instead of being embedded again.
+    results = store.similarity_search_by_vector_with_relevance_scores(embed_query(query), k=fetch_k)
+    docs = [_doc_entry(doc, score) for doc, score in results]
+    if HYBRID_SEARCH:
+        docs = _fuse_lexical(store, query, docs, fetch_k, (HYBRID_CANDIDATES or 2 * k) if rerank else k)
 
     if rerank and len(docs) > 1:
         try:
-            reranker = _get_reranker()
-            pairs = [(query, d["content"]) for d in docs]
-            scores = reranker.predict(pairs)
+            scores = rerank_scores(query, docs)
             for i, s in enumerate(scores):
                 docs[i]["rerank_score"] = float(s)
             docs.sort(key=lambda x: x.get("rerank_score", 0), reverse=True)
@@ -102,6 +170,7 @@ def retrieve(store: Chroma, query: str, k: int = None, rerank: bool = True):
     for d in final:
         d.pop("full_content", None)
         d.pop("rerank_score", None)
+        d.pop("chunk_id", None)
     return final
 
 def build_context_block(docs: list[dict]) -> str:
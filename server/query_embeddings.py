@@ -0,0 +1,48 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from config import QUERY_EMBED_CACHE_SIZE
+from lru import LRUCache
+
+# One chat request embeds its question for the semantic cache lookup, for
+# retrieval (possibly from several tools) and again for the cache put. Vectors
+# are kept per request in a context variable, which run_in_threadpool and the
+# agent's tool executor copy into worker threads, and in a small LRU shared
+# across requests.
+_scope: ContextVar[dict | None] = ContextVar("query_embeddings", default=None)
+_recent = LRUCache(QUERY_EMBED_CACHE_SIZE)
+_embedded = 0
+
+def get_query_embedder():
+    # The registry's shared instance; vectorstore registers the loader.
+    from vectorstore import get_embeddings
+    return get_embeddings()
+
+@contextmanager
+def query_scope(scope: dict = None):
+    """Share query vectors among everything run inside this block."""
+    token = _scope.set({} if scope is None else scope)
+    try:
+        yield
+    finally:
+        try:
+            _scope.reset(token)
+        except ValueError:
+            # A streaming generator finalized from another context.
+            pass
+
+def embed_query(text: str) -> list[float]:
+    global _embedded
+    scope = _scope.get()
+    if scope is not None and text in scope:
+        return scope[text]
+    vec = _recent.get(text)
+    if vec is None:
+        vec = get_query_embedder().embed_query(text)
+        _recent.put(text, vec)
+        _embedded += 1
+    if scope is not None:
+        scope[text] = vec
+    return vec
+
+def query_embedding_stats() -> dict:
+    return {"embedded": _embedded, **_recent.stats()}
@@ -0,0 +1,126 @@
+import math
+import os
+import tempfile
+import time
+from pathlib import Path
+import numpy as np
+
+# Rows scored per matmul; keeps the float32 temporary small when the index is a
+# float16 memmap.
+_SCORE_CHUNK = 65536
+
+def _score_rows(embeddings, query: np.ndarray, rows: np.ndarray = None) -> np.ndarray:
+    n = len(embeddings) if rows is None else len(rows)
+    out = np.empty(n, dtype=np.float32)
+    for start in range(0, n, _SCORE_CHUNK):
+        stop = min(start + _SCORE_CHUNK, n)
+        block = embeddings[start:stop] if rows is None else embeddings[rows[start:stop]]
+        out[start:stop] = np.asarray(block, dtype=np.float32) @ query
+    return out
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Positions of the k highest scores, best first, without a full sort."""
+    if k >= len(scores):
+        return np.argsort(scores)[::-1]
+    part = np.argpartition(scores, -k)[-k:]
+    return part[np.argsort(scores[part])[::-1]]
+
+class ExactBackend:
+    name = "exact"
+
+    def __init__(self, embeddings):
+        self.embeddings = embeddings
+
+    def search(self, query: np.ndarray, k: int, rows: np.ndarray = None) -> tuple[np.ndarray, np.ndarray]:
+        scores = _score_rows(self.embeddings, query, rows)
+        best = top_k(scores, k)
+        ids = best if rows is None else rows[best]
+        return ids, scores[best]
+
+class IVFBackend:
+    """Inverted-file index: spherical k-means lists, only the nprobe closest are scanned."""
+    name = "ivf"
+
+    def __init__(self, embeddings, centroids: np.ndarray, order: np.ndarray, offsets: np.ndarray, nprobe: int = 8):
+        self.embeddings = embeddings
+        self.centroids = centroids
+        self.order = order
+        self.offsets = offsets
+        self.nprobe = nprobe
+        self._exact = ExactBackend(embeddings)
+
+    @classmethod
+    def train(cls, embeddings, nlist: int = 0, nprobe: int = 8, iters: int = 10,
+              train_size: int = 50000, seed: int = 0) -> "IVFBackend":
+        n = len(embeddings)
+        nlist = nlist or max(1, int(math.sqrt(n)))
+        nlist = min(nlist, n)
+        rng = np.random.default_rng(seed)
+        sample_rows = np.sort(rng.choice(n, size=min(n, max(train_size, nlist)), replace=False))
+        sample = np.asarray(embeddings[sample_rows], dtype=np.float32)
+
+        centroids = sample[rng.choice(len(sample), size=nlist, replace=False)].copy()
+        for _ in range(iters):
+            assign = (sample @ centroids.T).argmax(axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, sample)
+            empty = np.bincount(assign, minlength=nlist) == 0
+            # Re-seed empty lists from random samples so nlist stays meaningful.
+            sums[empty] = sample[rng.choice(len(sample), size=int(empty.sum()))]
+            centroids = sums / np.maximum(np.linalg.norm(sums, axis=1, keepdims=True), 1e-12)
+
+        labels = np.empty(n, dtype=np.int32)
+        for start in range(0, n, _SCORE_CHUNK):
+            stop = min(start + _SCORE_CHUNK, n)
+            block = np.asarray(embeddings[start:stop], dtype=np.float32)
+            labels[start:stop] = (block @ centroids.T).argmax(axis=1)
+
+        order = np.argsort(labels, kind="stable").astype(np.int64)
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(labels, minlength=nlist))]).astype(np.int64)
+        return cls(embeddings, centroids, order, offsets, nprobe)
+
+    def save(self, path: Path):
+        # A unique temp file: several workers may save the same version at once.
+        with tempfile.NamedTemporaryFile(dir=path.parent, prefix=path.name + ".", suffix=".tmp", delete=False) as f:
+            np.savez(f, centroids=self.centroids, order=self.order, offsets=self.offsets)
+        os.replace(f.name, path)
+
+    @classmethod
+    def load(cls, path: Path, embeddings, nprobe: int = 8) -> "IVFBackend":
+        data = np.load(path)
+        return cls(embeddings, data["centroids"], data["order"], data["offsets"], nprobe)
+
+    def _probe_rows(self, query: np.ndarray, nprobe: int) -> np.ndarray:
+        lists = top_k(self.centroids @ query, min(nprobe, len(self.centroids)))
+        rows = np.concatenate([self.order[self.offsets[i]:self.offsets[i + 1]] for i in lists])
+        # Sorted rows keep memmap reads mostly sequential.
+        return np.sort(rows)
+
+    def search(self, query: np.ndarray, k: int, rows: np.ndarray = None, nprobe: int = None) -> tuple[np.ndarray, np.ndarray]:
+        if rows is not None:
+            # Pre-filtered subsets are already small; score them exactly.
+            return self._exact.search(query, k, rows)
+        return self._exact.search(query, k, self._probe_rows(query, nprobe or self.nprobe))
+
+def recall_report(embeddings, queries: np.ndarray, ivf: IVFBackend, k: int = 16,
+                  nprobes: tuple = (1, 2, 4, 8, 16, 32)) -> list[dict]:
+    exact = ExactBackend(embeddings)
+    truth = []
+    t0 = time.perf_counter()
+    for q in queries:
+        truth.append(set(exact.search(q, k)[0].tolist()))
+    exact_ms = (time.perf_counter() - t0) * 1000 / len(queries)
+
+    rows = [{"backend": "exact", "nprobe": None, "recall": 1.0, "avg_ms": round(exact_ms, 3)}]
+    for nprobe in nprobes:
+        if nprobe > len(ivf.centroids):
+            break
+        hits = 0
+        t0 = time.perf_counter()
+        found = [ivf.search(q, k, nprobe=nprobe)[0] for q in queries]
+        ms = (time.perf_counter() - t0) * 1000 / len(queries)
+        for ids, want in zip(found, truth):
+            hits += len(want.intersection(ids.tolist()))
+        recall = hits / sum(len(t) for t in truth)
+        rows.append({"backend": "ivf", "nprobe": nprobe, "recall": round(recall, 4), "avg_ms": round(ms, 3)})
+    return rows
@@ -0,0 +1,91 @@
+import copy
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Callable
+from config import MODEL_LOAD_POLICY, STARTUP_WORKERS
+
+@dataclass
+class ModelSpec:
+    name: str
+    load: Callable[[], object]
+    warmup: Callable[[], None] | None = None
+
+_lock = threading.Lock()
+_report: dict = {"ready": False, "total_ms": None, "steps": []}
+_started = time.perf_counter()
+
+def _ms(start: float) -> int:
+    return int((time.perf_counter() - start) * 1000)
+
+def _record(entry: dict):
+    with _lock:
+        _report["steps"].append(entry)
+
+def policy_for(name: str) -> str:
+    return MODEL_LOAD_POLICY.get(name, MODEL_LOAD_POLICY.get("*", "eager"))
+
+@contextmanager
+def startup_step(name: str):
+    """Time a blocking startup stage (vectorstore, index load, ...) into the report."""
+    entry = {"name": name, "kind": "stage", "status": "running"}
+    start = time.perf_counter()
+    try:
+        yield
+        entry["status"] = "ready"
+    except Exception as e:
+        entry.update({"status": "error", "error": str(e)})
+        raise
+    finally:
+        entry["ms"] = _ms(start)
+        _record(entry)
+
+def _load_model(spec: ModelSpec) -> dict:
+    entry = {"name": spec.name, "kind": "model", "policy": "eager", "status": "loading"}
+    start = time.perf_counter()
+    try:
+        spec.load()
+        entry["load_ms"] = _ms(start)
+        if spec.warmup is not None:
+            warm_start = time.perf_counter()
+            spec.warmup()
+            entry["warmup_ms"] = _ms(warm_start)
+        entry["status"] = "ready"
+    except Exception as e:
+        entry.update({"status": "error", "error": str(e)})
+        print(f"Warm-up of {spec.name} failed: {e}")
+    entry["ms"] = _ms(start)
+    return entry
+
+def warm_up_models(specs: list[ModelSpec]):
+    eager = [s for s in specs if policy_for(s.name) == "eager"]
+    for spec in specs:
+        if spec not in eager:
+            _record({"name": spec.name, "kind": "model", "policy": "lazy", "status": "deferred"})
+
+    start = time.perf_counter()
+    if eager:
+        print(f"Warming up {', '.join(s.name for s in eager)}")
+        with ThreadPoolExecutor(max_workers=max(1, min(STARTUP_WORKERS, len(eager)))) as pool:
+            for entry in pool.map(_load_model, eager):
+                _record(entry)
+
+    with _lock:
+        _report["models_ms"] = _ms(start)
+        _report["total_ms"] = _ms(_started)
+        _report["ready"] = True
+    print(f"Startup complete in {_report['total_ms']} ms")
+
+def start_warm_up(specs: list[ModelSpec]) -> threading.Thread:
+    thread = threading.Thread(target=warm_up_models, args=(specs,), name="model-warmup", daemon=True)
+    thread.start()
+    return thread
+
+def is_ready() -> bool:
+    return _report["ready"]
+
+def startup_report() -> dict:
+    with _lock:
+        return copy.deepcopy(_report)
@@ -0,0 +1,85 @@
+import os
+import sys
+import tempfile
+import zlib
+from pathlib import Path
+
+# Point every data path at a scratch directory before config is imported.
+_tmp = Path(tempfile.mkdtemp(prefix="saga-tests-"))
+for key, name in {
+    "IMAGES_DIR": "images",
+    "CLIP_INDEX_DIR": "clip_store",
+    "CLIP_INDEX_PATH": "clip_index.pkl",
+    "CHROMA_DIR": "chroma",
+    "REPORTS_DIR": "reports",
+    "LOG_DB_PATH": "logs.db",
+}.items():
+    os.environ[key] = str(_tmp / name)
+os.environ["CLIP_INDEX_WORKERS"] = "1"
+(_tmp / "images").mkdir()
+(_tmp / "reports").mkdir()
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+
+class _Processor:
+    """Hashes words to token ids, so the tiny CLIP needs no downloaded tokenizer."""
+
+    def __init__(self):
+        from transformers import CLIPImageProcessor
+        self.images = CLIPImageProcessor()
+
+    def __call__(self, text=None, images=None, return_tensors="pt", padding=True, truncation=True):
+        out = {}
+        if text is not None:
+            ids = [[zlib.crc32(w.encode()) % 990 + 5 for w in t.split()][:16] for t in text]
+            n = max(len(i) for i in ids)
+            out["input_ids"] = torch.tensor([i + [0] * (n - len(i)) for i in ids])
+            out["attention_mask"] = torch.tensor([[1] * len(i) + [0] * (n - len(i)) for i in ids])
+        if images is not None:
+            out.update(self.images(images=images, return_tensors="pt"))
+        return out
+
+def _tiny_clip():
+    from transformers import CLIPConfig, CLIPModel
+    torch.manual_seed(0)
+    cfg = CLIPConfig(
+        text_config=dict(vocab_size=1000, hidden_size=32, intermediate_size=64, num_hidden_layers=1,
+                         num_attention_heads=2, max_position_embeddings=32, eos_token_id=2),
+        vision_config=dict(hidden_size=32, intermediate_size=64, num_hidden_layers=1, num_attention_heads=2,
+                           image_size=224, patch_size=32),
+        projection_dim=16,
+    )
+    return CLIPModel(cfg).eval(), _Processor()
+
+@pytest.fixture(scope="session")
+def tiny_clip():
+    import models
+    import clip_index  # registers the "clip" loader
+    models._slots["clip"].loader = _tiny_clip
+    models.unload_model("clip")
+    return models.get_model("clip")
+
+@pytest.fixture
+def images_dir():
+    return Path(os.environ["IMAGES_DIR"])
+
+def write_image(path: Path, seed: int, size=(80, 64)):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    Image.fromarray(rng.integers(0, 255, (size[1], size[0], 3), dtype=np.uint8)).save(path)
+
+@pytest.fixture
+def clip_index_with_images(tiny_clip, images_dir):
+    import clip_index
+    for f in images_dir.rglob("*"):
+        if f.is_file():
+            f.unlink()
+    write_image(images_dir / "a" / "small.png", 1, (80, 64))
+    write_image(images_dir / "a" / "wide.png", 2, (400, 120))
+    write_image(images_dir / "b" / "large.png", 3, (320, 320))
+    clip_index.rebuild_clip_index()
+    return clip_index
@@ -0,0 +1,17 @@
+def test_search_images_tool_exposes_size_filters():
+    import agent
+    props = agent.search_images.args
+    assert "min_width" in props and "min_height" in props
+
+def test_search_images_tool_filters_by_size(clip_index_with_images):
+    import agent
+    out = agent.search_images.invoke({"query": "corrosion", "num_results": 8, "min_width": 300})
+    assert "wide.png" in out and "large.png" in out and "small.png" not in out
+    out = agent.search_images.invoke({"query": "corrosion", "num_results": 8, "min_width": 300, "min_height": 300})
+    assert "large.png" in out and "wide.png" not in out
+
+def test_display_search_passes_size_filters(clip_index_with_images):
+    import agent
+    imgs = agent._search_images_for_display("corrosion", {"query": "corrosion", "min_height": 300})
+    assert [img["path"].rsplit("/", 1)[-1] for img in imgs] == ["large.png"]
+    assert all(img["height"] >= 300 for img in imgs)
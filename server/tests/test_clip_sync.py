@@ -0,0 +1,62 @@
+from conftest import write_image
+
+def test_sync_skips_undecodable_image_until_it_changes(clip_index_with_images, images_dir):
+    ci = clip_index_with_images
+    bad = images_dir / "b" / "broken.jpg"
+    bad.write_bytes(b"not a jpeg")
+
+    first = ci.rebuild_clip_index("incremental")
+    version = first["version"]
+    assert len(first["paths"]) == 3
+    assert str(bad) in ci._load_failed()
+
+    for _ in range(3):
+        again = ci.rebuild_clip_index("incremental")
+        assert again["version"] == version
+    assert ci._rebuild_progress["skipped_failed"] == 1
+
+    # Fixed file: retried, indexed, and dropped from the failure record.
+    bad.unlink()
+    write_image(bad, 7)
+    fixed = ci.rebuild_clip_index("incremental")
+    assert fixed["version"] != version
+    assert len(fixed["paths"]) == 4
+    assert str(bad) not in ci._load_failed()
+
+def test_sync_without_changes_keeps_version(clip_index_with_images):
+    ci = clip_index_with_images
+    version = ci.index_version()
+    assert ci.rebuild_clip_index("incremental")["version"] == version
+
+def test_concurrent_pickle_migration(clip_index_with_images):
+    import pickle
+    import shutil
+    import threading
+    from pathlib import Path
+    import numpy as np
+    ci = clip_index_with_images
+    index = ci.load_clip_index()
+    legacy = Path(ci.CLIP_INDEX_PATH)
+    with open(legacy, "wb") as f:
+        pickle.dump({"paths": list(index["paths"]), "embeddings": np.asarray(index["embeddings"]),
+                     "labels": list(index["labels"])}, f)
+    shutil.rmtree(ci.CLIP_INDEX_DIR)
+
+    results, errors = [], []
+    def migrate():
+        try:
+            results.append(ci._migrate_pickle())
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=migrate) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert errors == []
+    assert all(r is not None and len(r["paths"]) == 3 for r in results)
+    assert not legacy.exists()
+    assert legacy.with_name(legacy.name + ".migrated").exists()
+    assert not list(legacy.parent.glob(legacy.name + ".*.migrating"))
+    legacy.with_name(legacy.name + ".migrated").unlink()
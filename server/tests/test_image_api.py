@@ -0,0 +1,22 @@
+from fastapi.testclient import TestClient
+
+def _client():
+    import api
+    # No lifespan: the index fixture has already loaded what these routes need.
+    return TestClient(api.app)
+
+def test_classified_images_route_is_not_shadowed_by_static_mount(clip_index_with_images):
+    resp = _client().get("/classified-images")
+    assert resp.status_code == 200
+    images = resp.json()["images"]
+    assert len(images) == 3
+    assert {"path", "top_defect", "severity"} <= set(images[0])
+
+def test_classified_images_filters_by_severity(clip_index_with_images):
+    every = _client().get("/classified-images").json()["images"]
+    severity = every[0]["severity"]
+    resp = _client().get("/classified-images", params={"severity": severity})
+    assert resp.status_code == 200
+    got = resp.json()["images"]
+    assert got and all(img["severity"] == severity for img in got)
+    assert _client().get("/classified-images", params={"severity": "nonsense"}).json()["images"] == []
@@ -0,0 +1,48 @@
+import threading
+from pathlib import Path
+import pytest
+
+@pytest.fixture
+def ann(monkeypatch):
+    import clip_index
+    monkeypatch.setattr(clip_index, "CLIP_SEARCH_BACKEND", "ann")
+    monkeypatch.setattr(clip_index, "ANN_MIN_SIZE", 2)
+    monkeypatch.setattr(clip_index, "ANN_NLIST", 2)
+    monkeypatch.setattr(clip_index, "_backend", None)
+    return clip_index
+
+def _count_training(monkeypatch, ci):
+    calls = []
+    train = ci.IVFBackend.train.__func__
+    def counting(cls, *args, **kwargs):
+        calls.append(1)
+        return train(cls, *args, **kwargs)
+    monkeypatch.setattr(ci.IVFBackend, "train", classmethod(counting))
+    return calls
+
+def test_ivf_is_trained_when_the_index_is_saved(ann, clip_index_with_images, monkeypatch):
+    ci = clip_index_with_images
+    ci.rebuild_clip_index()
+    ivf = Path(ci.CLIP_INDEX_DIR) / f"ivf-{ci.index_version()}.npz"
+    assert ivf.exists()
+
+    calls = _count_training(monkeypatch, ci)
+    assert ci.search_images("corrosion", k=2)
+    assert isinstance(ci._backend[1], ci.IVFBackend)
+    assert calls == []
+
+def test_lazy_ivf_training_runs_once_under_concurrency(ann, clip_index_with_images, monkeypatch):
+    ci = clip_index_with_images
+    index = ci.load_clip_index()
+    (Path(ci.CLIP_INDEX_DIR) / f"ivf-{index['version']}.npz").unlink(missing_ok=True)
+    calls = _count_training(monkeypatch, ci)
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(ci._get_search_backend(index))) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(calls) == 1
+    assert all(b is results[0] for b in results)
+    assert not list(Path(ci.CLIP_INDEX_DIR).glob("*.tmp"))
@@ -0,0 +1,33 @@
+import pytest
+
+@pytest.fixture
+def cache(monkeypatch):
+    import cache as cache_module
+    vectors = {
+        "query": [1.0, 0.0, 0.0],
+        "stale neighbour": [1.0, 0.0, 0.0],
+        "fresh neighbour": [0.99, 0.14, 0.0],
+    }
+    versions = {"reports": {"a": "v1", "b": "v1"}}
+    monkeypatch.setattr(cache_module, "embed_query", lambda text: vectors[text])
+    monkeypatch.setattr(cache_module, "_current_versions", lambda: (dict(versions["reports"]), "corpus", "index"))
+    c = cache_module.SemanticCache(max_size=8, persist_path=None, ttl=0)
+    c.versions = versions
+    return c
+
+def test_stale_best_match_does_not_hide_fresh_hit(cache):
+    cache.put("stale neighbour", "old answer", ["a s.1"])
+    cache.put("fresh neighbour", "good answer", ["b s.2"])
+    cache.versions["reports"] = {"a": "v2", "b": "v1"}
+
+    hit = cache.get("query")
+    assert hit is not None and hit["answer"] == "good answer"
+    assert cache.size == 1
+    assert cache.invalidated == 1
+
+def test_all_stale_is_a_miss(cache):
+    cache.put("stale neighbour", "old answer", ["a s.1"])
+    cache.versions["reports"] = {"a": "v2", "b": "v1"}
+    assert cache.get("query") is None
+    assert cache.size == 0
+    assert cache.misses == 1
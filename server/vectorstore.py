@@ -1,118 +1,385 @@
 from pathlib import Path
 import glob
+import hashlib
+import json
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from itertools import islice
+from typing import Iterator
 from langchain_community.document_loaders import PyPDFLoader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_chroma import Chroma
-from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from bm25 import load_lexical_index, index_chunks, remove_chunks
+from models import register_model, get_model
 from config import (
     REPORTS_DIR,
     CHROMA_PERSIST_DIR,
     CHUNK_SIZE,
     CHUNK_OVERLAP,
+    PDF_WORKERS,
+    INGEST_BATCH_SIZE,
     EMBEDDING_MODEL,
+    INFERENCE_BACKEND,
 )
 
-def get_embeddings():
+def _load_embedder():
+    if INFERENCE_BACKEND == "onnx":
+        from onnx_backend import OnnxEmbeddings
+        return OnnxEmbeddings(EMBEDDING_MODEL)
+    from langchain_huggingface import HuggingFaceEmbeddings
     return HuggingFaceEmbeddings(
         model_name=EMBEDDING_MODEL,
         encode_kwargs={"normalize_embeddings": True},
     )
 
-def load_and_chunk_pdfs() -> list[Document]:
-    pdf_files = glob.glob(str(Path(REPORTS_DIR) / "*.pdf"))
-    if not pdf_files:
-        print(f"No pdf reports found in {REPORTS_DIR}")
-        return []
+register_model("embedder", _load_embedder)
 
-    print(f"Found {len(pdf_files)} PDF reports, loading and chunking.")
-    all_chunks = []
-    splitter = RecursiveCharacterTextSplitter(
+class SharedEmbeddings(Embeddings):
+    """Looks the embedder up in the model registry on every call, so Chroma and
+    the semantic cache share one instance and neither keeps it from unloading."""
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return get_model("embedder").embed_documents(texts)
+
+    def embed_query(self, text: str) -> list[float]:
+        return get_model("embedder").embed_query(text)
+
+def get_embeddings() -> Embeddings:
+    return SharedEmbeddings()
+
+def _splitter() -> RecursiveCharacterTextSplitter:
+    return RecursiveCharacterTextSplitter(
         chunk_size=CHUNK_SIZE,
         chunk_overlap=CHUNK_OVERLAP,
         separators=["\n\n\n", "\n\n", "\n", ". ", " ", ""],
         add_start_index=True,
     )
 
-    for pdf_path in pdf_files:
-        filename = Path(pdf_path).stem
-        print(f"Loading {filename}")
+def _chunk_pages(pages: list[Document], stem: str) -> list[Document]:
+    for page in pages:
+        page_num = page.metadata.get("page", 0) + 1
+        page.metadata["source_label"] = f"{stem} s.{page_num}"
+        page.metadata["report"] = stem
+        page.metadata["page_num"] = page_num
+    return _splitter().split_documents(pages)
+
+def _parse_pdf(pdf_path: str) -> tuple[str, list[Document], str]:
+    # Runs in a worker process; errors are returned so one bad file does not
+    # abort the pool.
+    try:
+        pages = PyPDFLoader(pdf_path).load()
+        return pdf_path, _chunk_pages(pages, Path(pdf_path).stem), ""
+    except Exception as e:
+        return pdf_path, [], str(e)
+
+def _iter_parsed(pdf_files: list[str]) -> Iterator[tuple[str, list[Document], str]]:
+    if PDF_WORKERS <= 1 or len(pdf_files) <= 1:
+        for path in pdf_files:
+            yield _parse_pdf(path)
+        return
+
+    # spawn: the server process already holds model threads and DB handles.
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=PDF_WORKERS, mp_context=ctx) as pool:
+        paths = iter(pdf_files)
+        # A bounded number of files in flight, so parsed chunks do not pile up
+        # faster than they can be embedded.
+        pending = {pool.submit(_parse_pdf, p) for p in islice(paths, PDF_WORKERS * 2)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for path in islice(paths, len(done)):
+                pending.add(pool.submit(_parse_pdf, path))
+            for fut in done:
+                yield fut.result()
+
+def _report_failures(failures: list[dict]):
+    if failures:
+        print(f"{len(failures)} reports could not be parsed:")
+        for f in failures:
+            print(f"   {f['report']}: {f['error']}")
+
+# The manifest records which version of each report is in the store. It lives
+# inside the Chroma directory so that deleting the store also resets it.
+def _manifest_path() -> Path:
+    return Path(CHROMA_PERSIST_DIR) / "reports_manifest.json"
+
+def _load_manifest() -> dict:
+    path = _manifest_path()
+    if not path.exists():
+        return {}
+    return json.loads(path.read_text(encoding="utf-8"))
+
+# Files that failed to parse, so they are not retried until their content changes.
+def _failed_path() -> Path:
+    return Path(CHROMA_PERSIST_DIR) / "reports_failed.json"
+
+def _load_failed() -> dict:
+    path = _failed_path()
+    if not path.exists():
+        return {}
+    return json.loads(path.read_text(encoding="utf-8"))
+
+def _save_failed(failed: dict):
+    path = _failed_path()
+    if not failed:
+        path.unlink(missing_ok=True)
+        return
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(failed, indent=1), encoding="utf-8")
+
+def _save_manifest(manifest: dict):
+    global _report_hashes, _corpus_version
+    previous = report_versions()
+    path = _manifest_path()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(json.dumps(manifest, indent=1), encoding="utf-8")
+    os.replace(tmp, path)
+
+    _report_hashes = {report: entry["hash"] for report, entry in manifest.items()}
+    _corpus_version = None
+    changed = {r for r in previous.keys() | _report_hashes.keys() if previous.get(r) != _report_hashes.get(r)}
+    if changed:
+        for listener in _report_listeners:
+            try:
+                listener(changed)
+            except Exception as e:
+                print(f"Report change listener failed: {e}")
+
+# Callers that derive data from reports (the semantic cache) register here and
+# are told which reports were added, replaced or removed.
+_report_listeners: list = []
+_report_hashes: dict | None = None
+_corpus_version: str | None = None
+
+def add_report_listener(fn):
+    _report_listeners.append(fn)
+
+def report_versions() -> dict[str, str]:
+    """Content hash of every indexed report, by report name."""
+    global _report_hashes
+    if _report_hashes is None:
+        _report_hashes = {report: entry["hash"] for report, entry in _load_manifest().items()}
+    return _report_hashes
+
+def corpus_version() -> str:
+    global _corpus_version
+    if _corpus_version is None:
+        key = json.dumps([sorted(report_versions().items()), EMBEDDING_MODEL, CHUNK_SIZE, CHUNK_OVERLAP])
+        _corpus_version = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+    return _corpus_version
+
+def _file_hash(path: Path) -> str:
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def _chunk_ids(report: str, digest: str, n: int) -> list[str]:
+    # Same file content always gives the same ids, so re-syncing is an upsert,
+    # and a changed report gets new ids (no stale rerank cache entries).
+    return [f"{report}:{digest[:16]}:{i}" for i in range(n)]
+
+def _report_chunk_ids(store: Chroma, report: str) -> list[str]:
+    return store.get(where={"report": report}, include=[])["ids"]
 
-        try:
-            loader = PyPDFLoader(pdf_path)
-            pages = loader.load()
-        except Exception as e:
-            print(f"Error with {filename}: {e}")
-            continue
+def _manifest_entry(path: Path, digest: str, chunks: int) -> dict:
+    st = path.stat()
+    return {"file": path.name, "size": st.st_size, "mtime": st.st_mtime, "hash": digest, "chunks": chunks}
 
-        for page in pages:
-            page_num = page.metadata.get("page", 0) + 1
-            page.metadata["source_label"] = f"{filename} s.{page_num}"
-            page.metadata["report"] = filename
-            page.metadata["page_num"] = page_num
+def _unchanged(path: Path, entry: dict | None) -> bool:
+    if not entry:
+        return False
+    st = path.stat()
+    if st.st_size == entry["size"] and st.st_mtime == entry["mtime"]:
+        return True
+    if st.st_size == entry["size"] and _file_hash(path) == entry["hash"]:
+        entry["mtime"] = st.st_mtime
+        return True
+    return False
 
-        chunks = splitter.split_documents(pages)
-        all_chunks.extend(chunks)
-        print(f"{len(chunks)} chunks from {filename}")
+def _write_reports(store: Chroma, reports: list[tuple], manifest: dict, progress: dict = None) -> tuple[int, int]:
+    """Upsert the chunks of several parsed reports, then drop their superseded chunks."""
+    old_ids = {report: set(_report_chunk_ids(store, report)) for report, *_ in reports}
+    docs, ids = [], []
+    for report, path, digest, chunks in reports:
+        docs.extend(chunks)
+        ids.extend(_chunk_ids(report, digest, len(chunks)))
+    for start in range(0, len(docs), INGEST_BATCH_SIZE):
+        batch, batch_ids = docs[start:start + INGEST_BATCH_SIZE], ids[start:start + INGEST_BATCH_SIZE]
+        store.add_documents(batch, ids=batch_ids)
+        index_chunks(batch_ids, [d.page_content for d in batch])
+        if progress is not None:
+            progress["chunks_embedded"] = min(start + INGEST_BATCH_SIZE, len(docs))
 
-    print(f"Total {len(all_chunks)} chunks from {len(pdf_files)} reports")
-    return all_chunks
+    # New chunks are written before old ones are removed, so a report being
+    # replaced stays searchable throughout.
+    written = set(ids)
+    stale = [i for report in old_ids for i in old_ids[report] - written]
+    if stale:
+        store.delete(ids=stale)
+        remove_chunks(stale)
+    for report, path, digest, chunks in reports:
+        manifest[report] = _manifest_entry(path, digest, len(chunks))
+    return len(docs), len(stale)
+
+_sync_lock = threading.Lock()
+
+def _adopt_legacy(store: Chroma, files: dict[str, Path], manifest: dict) -> list[str]:
+    """Write manifest entries for a store built before the manifest existed.
+
+    Its chunks keep their random ids and are found by report metadata when the
+    report next changes; nothing is re-embedded. Returns the reports that are
+    indexed but no longer have a file.
+    """
+    counts = {}
+    for meta in store.get(include=["metadatas"])["metadatas"]:
+        if meta and meta.get("report"):
+            counts[meta["report"]] = counts.get(meta["report"], 0) + 1
+    for report, path in files.items():
+        if report in counts:
+            manifest[report] = _manifest_entry(path, _file_hash(path), counts[report])
+    if counts:
+        print(f"Adopted {len(manifest)} reports already in the vectorstore")
+    return sorted(set(counts) - set(files))
+
+def sync_reports(store: Chroma) -> dict:
+    """Bring the store in line with REPORTS_DIR, touching only new, changed or removed reports."""
+    with _sync_lock:
+        manifest = _load_manifest()
+        files = {Path(p).stem: Path(p) for p in glob.glob(str(Path(REPORTS_DIR) / "*.pdf"))}
+        adopted = 0
+        if manifest:
+            removed = [r for r in manifest if r not in files]
+        else:
+            removed = _adopt_legacy(store, files, manifest)
+            adopted = len(manifest)
+
+        failed = {r: e for r, e in _load_failed().items() if r in files}
+        changed, skipped = {}, 0
+        for report, path in files.items():
+            if _unchanged(path, manifest.get(report)):
+                failed.pop(report, None)
+            elif _unchanged(path, failed.get(report)):
+                skipped += 1
+            else:
+                changed[str(path)] = (report, _file_hash(path))
+
+        result = {
+            "added": 0,
+            "updated": 0,
+            "removed": len(removed),
+            "unchanged": len(files) - len(changed) - skipped,
+            "adopted": adopted,
+            "skipped_failed": skipped,
+            "chunks_added": 0,
+            "chunks_deleted": 0,
+            "failures": [],
+        }
+        if changed:
+            print(f"Syncing {len(changed)} new or changed reports with {PDF_WORKERS} workers")
+
+        def write(pending: list[tuple]):
+            for report, *_ in pending:
+                result["updated" if report in manifest else "added"] += 1
+                failed.pop(report, None)
+            added, deleted = _write_reports(store, pending, manifest)
+            result["chunks_added"] += added
+            result["chunks_deleted"] += deleted
+
+        pending, pending_chunks = [], 0
+        for path, chunks, error in _iter_parsed(list(changed)):
+            report, digest = changed[path]
+            if error:
+                # Keep whatever version of the report is already indexed, and do
+                # not retry this file until it changes.
+                result["failures"].append({"report": report, "error": error})
+                failed[report] = {**_manifest_entry(Path(path), digest, 0), "error": error}
+                continue
+            pending.append((report, Path(path), digest, chunks))
+            pending_chunks += len(chunks)
+            # Workers keep parsing while each batch is embedded and written.
+            if pending_chunks >= INGEST_BATCH_SIZE:
+                write(pending)
+                pending, pending_chunks = [], 0
+        if pending:
+            write(pending)
+
+        for report in removed:
+            ids = _report_chunk_ids(store, report)
+            if ids:
+                store.delete(ids=ids)
+                remove_chunks(ids)
+            result["chunks_deleted"] += len(ids)
+            manifest.pop(report, None)
+
+        _save_manifest(manifest)
+        _save_failed(failed)
+        print(
+            f"Reports synced: {result['added']} added, {result['updated']} updated, "
+            f"{result['removed']} removed, {result['unchanged']} unchanged"
+            + (f", {skipped} skipped (failed before, file unchanged)" if skipped else "")
+        )
+        _report_failures(result["failures"])
+        return result
 
 def build_vectorstore() -> Chroma:
     embeddings = get_embeddings()
-    if Path(CHROMA_PERSIST_DIR).exists():
-        print("Loading existing vectorstore")
-        store = Chroma(
-            persist_directory=CHROMA_PERSIST_DIR,
-            embedding_function=embeddings,
-        )
-    else:
-        chunks = load_and_chunk_pdfs()
-        if not chunks:
-            print("No chunks to index, creating empty vectorstore")
-            store = Chroma(
-                persist_directory=CHROMA_PERSIST_DIR,
-                embedding_function=embeddings,
-            )
-        else:
-            print("New vectorstore, creating from chunks")
-            store = Chroma.from_documents(
-                documents=chunks,
-                embedding=embeddings,
-                persist_directory=CHROMA_PERSIST_DIR,
-            )
+    print("Loading vectorstore" if Path(CHROMA_PERSIST_DIR).exists() else "New vectorstore, indexing reports")
+    store = Chroma(
+        persist_directory=CHROMA_PERSIST_DIR,
+        embedding_function=embeddings,
+    )
+    sync_reports(store)
+    load_lexical_index(store)
     print("Vectors ready")
     return store
 
-def ingest_pdf(store: Chroma, pdf_bytes: bytes, filename: str) -> int:
-    save_path = Path(REPORTS_DIR) / filename
-    save_path.write_bytes(pdf_bytes)
+def ingest_pdf(store: Chroma, pdf_bytes: bytes, filename: str, progress: dict = None) -> int:
+    """Add or replace one report; uploading a corrected file swaps out its old chunks.
 
-    splitter = RecursiveCharacterTextSplitter(
-        chunk_size=CHUNK_SIZE,
-        chunk_overlap=CHUNK_OVERLAP,
-        separators=["\n\n\n", "\n\n", "\n", ". ", " ", ""],
-        add_start_index=True,
-    )
+    If given, progress is updated in place with pages_total, pages_parsed,
+    chunks_total and chunks_embedded.
+    """
+    progress = {} if progress is None else progress
+    save_path = Path(REPORTS_DIR) / filename
+    # Parse from a side file so a bad upload never clobbers a good report.
+    tmp_path = save_path.with_name(save_path.name + ".part")
+    tmp_path.write_bytes(pdf_bytes)
 
     try:
-        loader = PyPDFLoader(str(save_path))
-        pages = loader.load()
+        from pypdf import PdfReader
+        progress["pages_total"] = len(PdfReader(str(tmp_path)).pages)
+        pages = []
+        for page in PyPDFLoader(str(tmp_path)).lazy_load():
+            pages.append(page)
+            progress["pages_parsed"] = len(pages)
     except Exception as e:
-        save_path.unlink(missing_ok=True)
+        tmp_path.unlink(missing_ok=True)
         raise RuntimeError(f"Could not parse PDF: {e}")
 
-    stem = Path(filename).stem
     for page in pages:
-        page_num = page.metadata.get("page", 0) + 1
-        page.metadata["source_label"] = f"{stem} s.{page_num}"
-        page.metadata["report"] = stem
-        page.metadata["page_num"] = page_num
-
-    chunks = splitter.split_documents(pages)
-    if chunks:
-        store.add_documents(chunks)
-        print(f"Ingested {len(chunks)} chunks from {filename}")
+        page.metadata["source"] = str(save_path)
+    report = save_path.stem
+    chunks = _chunk_pages(pages, report)
+    progress["chunks_total"] = len(chunks)
+    digest = hashlib.sha1(pdf_bytes).hexdigest()
+    with _sync_lock:
+        os.replace(tmp_path, save_path)
+        manifest = _load_manifest()
+        deleted = 0
+        if manifest.get(report, {}).get("hash") != digest:
+            _, deleted = _write_reports(store, [(report, save_path, digest, chunks)], manifest, progress)
+        else:
+            manifest[report] = _manifest_entry(save_path, digest, len(chunks))
+        progress["chunks_embedded"] = len(chunks)
+        _save_manifest(manifest)
+    print(f"Ingested {len(chunks)} chunks from {filename}" + (f", replaced {deleted}" if deleted else ""))
     return len(chunks)
 
 def rebuild_vectorstore() -> Chroma: